@@ -8,9 +8,6 @@ import os
 import sys
 import re
 from pathlib import Path
-import google.generativeai as genai
-from openai import OpenAI # Added for OpenRouter
-from tqdm import tqdm
 import time
 import colorama
 from colorama import Fore, Back, Style
@@ -20,12 +17,18 @@ from prompt_toolkit.auto_suggest import AutoSuggestFromHistory
 from prompt_toolkit.styles import Style as PromptStyle
 from prompt_toolkit.completion import Completer, Completion, PathCompleter, WordCompleter, CompleteEvent
 from prompt_toolkit.document import Document
-import glob
 import subprocess
 from prompt_toolkit.formatted_text import ANSI
 import difflib
 import threading # Need to import threading
+import functools
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import mmap
+import selectors
+import stat
 import signal # Needed for sending signals in interrupt handler
+import traceback
 
 # Initialize colorama
 colorama.init(autoreset=True)
@@ -33,6 +36,9 @@ colorama.init(autoreset=True)
 # --- Version --- 
 from . import __version__
 
+# Set CODAGENT_DEBUG=1 to get full tracebacks in apply logs
+DEBUG = bool(os.environ.get("CODAGENT_DEBUG"))
+
 # --- Border Characters ---
 TL = '╭' # Top Left
 TR = '╮' # Top Right
@@ -41,33 +47,123 @@ BR = '╯' # Bottom Right
 H = '─'  # Horizontal Line
 V = '│'  # Vertical Line
 
+# --- Terminal Width Cache ---
+_TERM_WIDTH = [None] # Cached terminal width, cleared when the terminal is resized
+
+def _term_width():
+    """Returns the terminal width in columns, cached until the next resize (default 80)."""
+    if _TERM_WIDTH[0] is None:
+        try:
+            _TERM_WIDTH[0] = os.get_terminal_size().columns
+        except OSError:
+            _TERM_WIDTH[0] = 80
+    return _TERM_WIDTH[0]
+
+# Invalidate the cached width on resize (POSIX only; Windows has no SIGWINCH)
+def _on_winch(signum, frame):
+    _TERM_WIDTH[0] = None
+    if callable(_PREV_WINCH_HANDLER): # Keep any handler that was installed before ours working
+        _PREV_WINCH_HANDLER(signum, frame)
+
+_PREV_WINCH_HANDLER = None
+
+def _install_winch_handler():
+    """Installs _on_winch for SIGWINCH, chaining whatever handler is currently set."""
+    global _PREV_WINCH_HANDLER
+    if not hasattr(signal, "SIGWINCH"):
+        return
+    try:
+        current = signal.getsignal(signal.SIGWINCH)
+        if current is not _on_winch:
+            _PREV_WINCH_HANDLER = current
+            signal.signal(signal.SIGWINCH, _on_winch)
+    except ValueError:
+        pass # Not in the main thread (e.g. imported from a worker); fall back to a one-time lookup
+
+def _refresh_term_width():
+    """Drops the cached width and re-arms the resize handler.
+
+    prompt_toolkit installs its own SIGWINCH handler while a prompt runs and restores SIG_DFL
+    (not ours) when it exits, so this runs after every prompt.
+    """
+    _TERM_WIDTH[0] = None
+    _install_winch_handler()
+
+_install_winch_handler()
+
 # --- Helper Function for Visible Length ---
+# ANSI escape sequences: an OSC string (e.g. hyperlinks, ended by BEL or ESC \\), a charset
+# selection (e.g. the ESC ( B from `tput sgr0`), a single-character escape, or a CSI sequence (like colors).
+# Compiled once; visible_len and _wrap_visible both use it, so measuring and wrapping agree.
+_ANSI_ESCAPE_RE = re.compile(r'\x1B(?:\][^\x07\x1B]*(?:\x07|\x1B\\)|[()*+][0-~]|[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])')
+
 def visible_len(text):
     """Calculates the visible length of a string by removing ANSI escape codes."""
-    # Use a more comprehensive regex for ANSI escape sequences.
-    # Handles CSI sequences (like colors) and other escape types.
-    ansi_escape = re.compile(r'''
-        \x1B  # ESC
-        (?:   # Non-capturing group
-            [@-Z\\-_] | # Single character escapes
-            \[ [0-?]* [ -/]* [@-~] # CSI sequence
-        )
-    ''', re.VERBOSE)
-    return len(ansi_escape.sub('', text))
+    if '\x1b' not in text: # Plain line: a C-level scan, no regex and no stripped copy
+        return len(text)
+    return len(_ANSI_ESCAPE_RE.sub('', text))
+
+# --- Helper Function for ANSI-aware Wrapping ---
+def _wrap_visible(line, width):
+    """Splits a line into chunks of at most `width` visible characters, keeping ANSI codes intact."""
+    if width <= 0:
+        return [line]
+    chunks = []
+    active_codes = [] # Escape sequences currently in effect (re-emitted on each new chunk)
+    current = []
+    current_visible = 0
+    carried = 0 # Number of leading entries in `current` carried over from the previous chunk
+
+    def add_text(pos, end):
+        """Adds the visible text line[pos:end], closing chunks as they fill up."""
+        nonlocal current, current_visible, carried
+        while pos < end:
+            if current_visible == width:
+                # Close the chunk and carry the active styling over to the next one
+                chunks.append(''.join(current) + (Style.RESET_ALL if active_codes else ''))
+                current = list(active_codes)
+                carried = len(current)
+                current_visible = 0
+            take = min(width - current_visible, end - pos)
+            current.append(line[pos:pos + take])
+            current_visible += take
+            pos += take
+
+    # Escape sequences are exactly what visible_len strips, so wrapping and measuring agree
+    pos = 0
+    for match in _ANSI_ESCAPE_RE.finditer(line):
+        add_text(pos, match.start())
+        code = match.group()
+        current.append(code)
+        if code in ('\x1b[0m', '\x1b[m'):
+            active_codes = []
+        elif code.startswith('\x1b[') and code.endswith('m'): # SGR (colour/style) codes stay in effect
+            active_codes.append(code)
+        pos = match.end()
+    add_text(pos, len(line))
+
+    if current_visible or not chunks:
+        chunks.append(''.join(current))
+    else:
+        # Trailing escape codes only (e.g. a final reset) belong to the last chunk
+        chunks[-1] += ''.join(current[carried:])
+    return chunks
 
 # --- Helper Function for Boxed Output ---
 def print_boxed(title, content, color=Fore.CYAN, width=None):
-    """Prints content inside a simulated rounded border, aware of ANSI codes."""
-    # Get terminal width, default to 80 if unavailable or too small
-    try:
-        term_width = os.get_terminal_size().columns
-    except OSError:
-        term_width = 80
+    """Prints content (a string or a list of lines) inside a simulated rounded border, aware of ANSI codes."""
+    # Get terminal width (cached), default to 80 if unavailable or too small
+    term_width = _term_width()
     max_width = width if width is not None else term_width
     max_width = max(max_width, 20) # Ensure a minimum reasonable width
 
-    lines = content.splitlines()
-    max_visible_line_width = max((visible_len(line) for line in lines), default=0)
+    if isinstance(content, str):
+        lines = content.splitlines()
+    else:
+        # Already a list of lines - no join/split round-trip (entries may still hold newlines)
+        lines = [line for item in content for line in (item.splitlines() or [''])]
+    line_widths = [visible_len(line) for line in lines] # Measured once; reused for padding below
+    max_visible_line_width = max(line_widths, default=0)
     visible_title_width = visible_len(title)
 
     # Calculate necessary inner width, constrained by max_width
@@ -75,43 +171,64 @@ def print_boxed(title, content, color=Fore.CYAN, width=None):
     box_width = min(required_inner_width + 4, max_width) # Add padding+borders, limit by max_width
     inner_width = box_width - 4 # Final inner width based on constrained box_width
 
+    out = [] # Collect the whole box and write it in one go
+    reset = Style.RESET_ALL # Bound once; used on every line
+    border = H * (box_width - 2) # Shared by the top and bottom borders
+    left = f"{color}{V} " # Constant line prefix/suffix, built once
+    right = f" {V}{reset}"
+    pads = {} # Padding strings by width; most lines share a handful of widths
+
     # --- Top border ---
-    print(f"{color}{TL}{H * (box_width - 2)}{TR}{Style.RESET_ALL}")
+    out.append(f"{color}{TL}{border}{TR}{reset}")
 
     # --- Title line ---
     title_padding_total = inner_width - visible_title_width
     title_pad_left = title_padding_total // 2
     title_pad_right = title_padding_total - title_pad_left
-    print(f"{color}{V} {' ' * title_pad_left}{Style.BRIGHT}{title}{Style.NORMAL}{' ' * title_pad_right} {V}{Style.RESET_ALL}")
+    out.append(f"{left}{' ' * title_pad_left}{Style.BRIGHT}{title}{Style.NORMAL}{' ' * title_pad_right}{right}")
 
     # --- Separator ---
-    print(f"{color}{V}{H * inner_width}{V}{Style.RESET_ALL}")
+    out.append(f"{color}{V}{H * inner_width}{V}{reset}")
 
     # --- Content lines ---
-    for line in lines:
-        v_len = visible_len(line)
-        padding_needed = inner_width - v_len
-        # Ensure padding isn't negative if line somehow exceeds inner_width (shouldn't happen with wrapping)
-        padding_needed = max(0, padding_needed)
-
-        # Basic wrapping (split long lines) - based on visible length
-        # This part is complex with ANSI codes, keep simple for now
-        # TODO: Improve wrapping logic for lines containing ANSI codes if needed
-        if v_len > inner_width:
-             # Crude split for now, might break colors across lines
-             # A proper ANSI-aware wrapper would be needed for perfection
-             print(f"{color}{V} {line[:inner_width]}{' ' * (inner_width-visible_len(line[:inner_width]))} {V}{Style.RESET_ALL}") # Attempt to pad truncated line
-             # Don't print rest for now to avoid complex state
-             print(f"{color}{V} ... (line truncated) ... {' ' * (inner_width - 24)} {V}{Style.RESET_ALL}")
-        else:
-            # Print line with calculated padding
-            print(f"{color}{V} {line}{' ' * padding_needed} {V}{Style.RESET_ALL}")
-
+    for line, line_width in zip(lines, line_widths):
+        if line_width <= inner_width: # Fits: pad using the width measured above
+            padding_needed = inner_width - line_width
+            pad = pads.get(padding_needed)
+            if pad is None:
+                pad = pads[padding_needed] = ' ' * padding_needed
+            out.append(''.join((left, line, pad, right)))
+            continue
+        # Too long: wrap (ANSI-aware). Every chunk but the last is exactly inner_width wide;
+        # only the last one is measured for its padding.
+        chunks = _wrap_visible(line, inner_width) or [line]
+        for chunk in chunks[:-1]:
+            out.append(''.join((left, chunk, right)))
+        padding_needed = max(0, inner_width - visible_len(chunks[-1]))
+        pad = pads.get(padding_needed)
+        if pad is None:
+            pad = pads[padding_needed] = ' ' * padding_needed
+        out.append(''.join((left, chunks[-1], pad, right)))
 
     # --- Bottom border ---
-    print(f"{color}{BL}{H * (box_width - 2)}{BR}{Style.RESET_ALL}")
+    out.append(f"{color}{BL}{border}{BR}{reset}")
+
+    sys.stdout.write("\n".join(out) + "\n")
+    sys.stdout.flush()
 
 # --- Function to get Codebase Structure ---
+def scan_workspace_files(startpath='.'):
+    """Lists workspace files as relative paths, pruning hidden and __pycache__ directories before descending."""
+    files = []
+    for root, dirs, filenames in os.walk(startpath, topdown=True):
+        # Prune in-place so os.walk never enters .git/, .venv/, __pycache__/ and similar
+        dirs[:] = [d for d in dirs if not d.startswith('.') and d != '__pycache__']
+        rel_root = os.path.relpath(root, startpath)
+        for name in filenames:
+            if not name.startswith('.'): # Hidden files were never matched by the old glob either
+                files.append(name if rel_root == '.' else os.path.join(rel_root, name))
+    return files
+
 def get_codebase_structure(startpath='.', ignore_dirs=None, ignore_files=None):
     """Generates a tree-like string representation of the directory structure."""
     if ignore_dirs is None:
@@ -120,29 +237,51 @@ def get_codebase_structure(startpath='.', ignore_dirs=None, ignore_files=None):
         ignore_files = {'.DS_Store'}
 
     tree = []
-    for root, dirs, files in os.walk(startpath, topdown=True):
-        # Filter directories in-place
-        dirs[:] = [d for d in dirs if d not in ignore_dirs and not d.startswith('.')]
-        # Filter files
-        files = [f for f in files if f not in ignore_files and not f.startswith('.')]
-
-        level = root.replace(startpath, '').count(os.sep)
-        indent = ' ' * 4 * (level)
-        tree.append(f"{indent}{os.path.basename(root)}/")
-        subindent = ' ' * 4 * (level + 1)
-        for f in sorted(files): # Sort files for consistent output
-            tree.append(f"{subindent}{f}")
+    indents = [''] # indents[level] is the prefix for that depth, built once per depth
+    # Depth-first over os.scandir with an explicit stack; ignored and hidden dirs are never opened
+    stack = [(startpath, os.path.basename(startpath), 0)]
+    while stack:
+        root, root_name, level = stack.pop()
+        dirs, files = [], []
+        try:
+            with os.scandir(root) as it:
+                for entry in it:
+                    name = entry.name
+                    if name.startswith('.'):
+                        continue
+                    if entry.is_dir(): # DirEntry caches the type, so no extra stat
+                        # Symlinked dirs are not descended into (as with os.walk's default)
+                        if name not in ignore_dirs and not entry.is_symlink():
+                            dirs.append(name)
+                    elif name not in ignore_files:
+                        files.append(name)
+        except OSError:
+            continue # Unreadable directory: skipped, like os.walk
+
+        while len(indents) <= level + 1:
+            indents.append(indents[-1] + '    ')
+        tree.append(f"{indents[level]}{root_name}/")
+        subindent = indents[level + 1]
+        tree.extend(subindent + f for f in sorted(files)) # Sort files for consistent output
+        # Push in reverse so subdirectories come off the stack in sorted order
+        for d in sorted(dirs, reverse=True):
+            stack.append((os.path.join(root, d), d, level + 1))
 
     # Remove the first line if it's just './' or '.'
     if tree and (tree[0] == './' or tree[0] == '.'):
-        tree = tree[1:]
+        del tree[0]
 
     return '\n'.join(tree)
 # --- End Function ---
 
+@functools.lru_cache(maxsize=None)
+def _cached_env(name):
+    """os.environ.get, memoized; call _cached_env.cache_clear() after setting a variable."""
+    return os.environ.get(name)
+
 def check_api_key():
     """Check if Google API key is set in environment variables."""
-    api_key = os.environ.get("GOOGLE_API_KEY")
+    api_key = _cached_env("GOOGLE_API_KEY")
     if not api_key:
         print(f"{Fore.YELLOW}Google API key not found in environment variables.{Style.RESET_ALL}")
         
@@ -165,6 +304,7 @@ def check_api_key():
             sys.exit(1)
         
         os.environ["GOOGLE_API_KEY"] = api_key
+        _cached_env.cache_clear()
         print(f"{Fore.GREEN}API key set for this session.{Style.RESET_ALL}")
     
     return api_key
@@ -172,7 +312,7 @@ def check_api_key():
 # --- Added: Check OpenRouter API Key ---
 def check_openrouter_api_key():
     """Check if OpenRouter API key is set in environment variables."""
-    api_key = os.environ.get("OPENROUTER_API_KEY")
+    api_key = _cached_env("OPENROUTER_API_KEY")
     if not api_key:
         print(f"{Fore.YELLOW}OpenRouter API key (OPENROUTER_API_KEY) not found in environment variables.{Style.RESET_ALL}")
         print("You can get one from https://openrouter.ai")
@@ -191,6 +331,7 @@ def check_openrouter_api_key():
             print(f"{Fore.YELLOW}No OpenRouter API key provided.{Style.RESET_ALL}")
             return None # Allow skipping
         os.environ["OPENROUTER_API_KEY"] = api_key
+        _cached_env.cache_clear()
         print(f"{Fore.GREEN}OpenRouter API key set for this session.{Style.RESET_ALL}")
     return api_key
 # --- End Added ---
@@ -204,6 +345,7 @@ def initialize_model(args):
         if not api_key:
              print(f"{Fore.RED}OpenRouter API key is required to use --omodel. Exiting.{Style.RESET_ALL}")
              sys.exit(1)
+        from openai import OpenAI # Imported here so Gemini sessions never load it
         try:
             # Point OpenAI client to OpenRouter endpoint
             client = OpenAI(
@@ -225,6 +367,7 @@ def initialize_model(args):
         if not api_key:
              print(f"{Fore.RED}Google API key is required if not using --omodel. Exiting.{Style.RESET_ALL}")
              sys.exit(1)
+        import google.generativeai as genai # Imported here; it pulls in grpc/protobuf, which OpenRouter sessions don't need
         genai.configure(api_key=api_key)
         try:
             model = genai.GenerativeModel(args.model)
@@ -368,11 +511,38 @@ end the REPLACE/TO tag
 """
     return system_prompt
 
+# Opening tags and a trailing [END], found in a single scan of each segment. The terminal and
+# file_op groups are deliberately loose (a superset of what the block parsers accept): they
+# only decide whether those parsers need to run at all.
+_TAG_RE = re.compile(
+    r"(?P<ask_files>^(?i:====== ASK_FOR_FILES)\s*$)"
+    r"|(?P<ask_user>^(?i:====== ASK_TO_USER format:)\w+)"
+    r"|(?P<terminal>^(?i:====== TERMINAL)\s)"
+    r"|(?P<file_op>====== (?i:CREATE|REPLACE|REWRITE)\s)"
+    r"|(?P<end>\[END\]\s*\Z)",
+    re.MULTILINE,
+)
+
+# Tag block patterns, compiled once instead of on every segment. All tags finish with `====== END`.
+_ASK_FOR_FILES_RE = re.compile(r"^====== ASK_FOR_FILES\s*\n(.*?)\n====== END\s*$", re.DOTALL | re.MULTILINE | re.IGNORECASE)
+_ASK_TO_USER_RE = re.compile(r"^====== ASK_TO_USER format:(\w+)\s*\n(.*?)\n====== END\s*$", re.DOTALL | re.MULTILINE | re.IGNORECASE)
+_TERMINAL_RE = re.compile(r"^====== TERMINAL\s*\n(.*?)\n====== END\s*$", re.DOTALL | re.MULTILINE | re.IGNORECASE)
+# CREATE / REPLACE...TO / REWRITE as one alternation, so a response is scanned once for all file ops
+_FILE_OP_RE = re.compile(
+    r"^====== (?:"
+    r"CREATE\s+(?P<create_name>[^\n]+)\n(?P<create_body>.*?)"
+    r"|REPLACE\s+(?P<replace_name>[^\n]+)\n(?P<replace_old>.*?)\n====== TO\n(?P<replace_new>.*?)"
+    r"|REWRITE\s+(?P<rewrite_name>[^\n]+)\n(?P<rewrite_body>.*?)"
+    r")\n====== END\s*$",
+    re.DOTALL | re.MULTILINE | re.IGNORECASE,
+)
+# Optional language and the fences, e.g. ```python ... ``` or ``` ... ```
+_CODE_FENCE_RE = re.compile(r"```[\w]*\n?(.*?)\n?```", re.DOTALL) # fullmatch()ed against pre-stripped text
+
 def parse_ask_for_files(response_text):
     """Parse the response text to extract suggested files from ====== ASK_FOR_FILES tag."""
-    # Use re.MULTILINE and re.DOTALL. Match content between the tags. Use generic END.
-    ask_pattern = r"^====== ASK_FOR_FILES\s*\n(.*?)\n====== END\s*$" # Changed AEND to END
-    match = re.search(ask_pattern, response_text, re.DOTALL | re.MULTILINE | re.IGNORECASE)
+    # Match content between the tags
+    match = _ASK_FOR_FILES_RE.search(response_text)
     if match:
         content = match.group(1).strip()
         files = [line.strip() for line in content.splitlines() if line.strip()]
@@ -383,9 +553,8 @@ def parse_ask_for_files(response_text):
 
 def parse_ask_to_user(response_text):
     """Parse the response text to extract user questions from ====== ASK_TO_USER tag."""
-    # Use re.MULTILINE and re.DOTALL to match content between the tags. Use generic END.
-    ask_pattern = r"^====== ASK_TO_USER format:(\w+)\s*\n(.*?)\n====== END\s*$" # Changed QEND to END
-    match = re.search(ask_pattern, response_text, re.DOTALL | re.MULTILINE | re.IGNORECASE)
+    # Match content between the tags
+    match = _ASK_TO_USER_RE.search(response_text)
     if match:
         question_format = match.group(1).strip().lower()
         content = match.group(2).strip()
@@ -418,27 +587,64 @@ def parse_ask_to_user(response_text):
 
 def parse_end_response(response_text):
     """Parse the response to check if it contains the END tag at the end."""
-    # Check if the response ends with [END] tag
-    if response_text.strip().endswith("[END]"):
+    # Check if the response ends with [END] tag (strip once and reuse it)
+    stripped = response_text.strip()
+    if stripped.endswith("[END]"):
         # Remove the [END] tag and return True to indicate this is the end
-        return response_text.strip()[:-5].strip(), True # Length of "[END]" is 5
+        return stripped[:-5].rstrip(), True # Length of "[END]" is 5; the start is already stripped
     
     # No END tag found, return the original response and False
     return response_text, False
 
+def _strip_end_tag_from_chunk(chunk_text):
+    """Returns a streamed chunk with a trailing [END] tag cut off, for display only."""
+    # The tag is only hidden when it starts inside this chunk, so the chunk alone decides;
+    # no need to re-scan the whole accumulated segment on every chunk
+    stripped = chunk_text.rstrip()
+    if stripped.endswith("[END]"):
+        return chunk_text[:len(stripped) - 5] # Length of "[END]" is 5
+    return chunk_text
+
 def parse_terminal_commands(response_text):
     """Parse the response text to extract terminal commands."""
     terminal_commands = []
 
-    # Find TERMINAL commands using the new format. Use generic END.
-    # Use re.MULTILINE and re.DOTALL
-    terminal_pattern = r"^====== TERMINAL\s*\n(.*?)\n====== END\s*$" # Changed TEND to END
-    for match in re.finditer(terminal_pattern, response_text, re.DOTALL | re.MULTILINE | re.IGNORECASE):
+    # Find TERMINAL commands using the new format
+    for match in _TERMINAL_RE.finditer(response_text):
         command = match.group(1).strip()
         terminal_commands.append(command)
 
     return terminal_commands
 
+# Captured command output keeps this many lines from the start and the end; the middle is only shown live
+CAPTURE_HEAD_LINES = 200
+CAPTURE_TAIL_LINES = 200
+# Live output is written in batches of this many bytes, or after this many seconds of quiet
+LIVE_FLUSH_BYTES = 4096
+LIVE_FLUSH_INTERVAL = 0.05
+
+def _new_capture():
+    """Bounded line buffer for one output stream of a running command."""
+    return {"head": [], "tail": collections.deque(maxlen=CAPTURE_TAIL_LINES), "dropped": 0, "partial": b'', "lock": threading.Lock()}
+
+def _capture_line(data, line):
+    """Stores `line` in the capture, evicting from the middle once head and tail are full."""
+    with data["lock"]:
+        if len(data["head"]) < CAPTURE_HEAD_LINES:
+            data["head"].append(line)
+        else:
+            if len(data["tail"]) == CAPTURE_TAIL_LINES:
+                data["dropped"] += 1
+            data["tail"].append(line)
+
+def _capture_text(data):
+    """Joins a capture back into text, marking where lines were left out."""
+    lines = list(data["head"])
+    if data["dropped"]:
+        lines.append(f"[... {data['dropped']} lines omitted ...]")
+    lines.extend(data["tail"])
+    return "\n".join(lines)
+
 def execute_terminal_command(command):
     """Execute a terminal command, capture its output, show live output, and handle Ctrl+C."""
     print("-" * 30)
@@ -451,24 +657,58 @@ def execute_terminal_command(command):
     interrupted = False
     process = None # Initialize process variable
 
-    stdout_data = {"lines": [], "lock": threading.Lock()}
-    stderr_data = {"lines": [], "lock": threading.Lock()}
+    # Bounded so commands with huge output don't hold all of it in memory
+    stdout_data = _new_capture()
+    stderr_data = _new_capture()
+
+    # Raw byte sink for live output; falls back to text writes if stdout has no binary layer
+    live_out = getattr(sys.stdout, 'buffer', None)
+    sys.stdout.flush() # Everything printed so far must land before the raw bytes
+
+    live_pending = bytearray() # Live output not yet written (selector path only)
+
+    def show(chunk):
+        """Writes raw bytes straight to the terminal."""
+        if live_out is not None:
+            live_out.write(chunk) # No decode/encode round-trip for live output
+            live_out.flush()
+        else:
+            sys.stdout.write(bytes(chunk).decode('utf-8', 'replace'))
+            sys.stdout.flush()
+
+    def flush_live():
+        """Writes out any batched live output."""
+        if live_pending:
+            show(live_pending)
+            del live_pending[:]
+
+    def feed(data, chunk):
+        """Adds the complete lines in a raw chunk to the final log."""
+        # Decode only complete lines, for the log (b'\n' never occurs inside a UTF-8 sequence)
+        *complete, data["partial"] = (data["partial"] + chunk).split(b'\n')
+        for raw_line in complete:
+            for line in raw_line.decode('utf-8', 'replace').splitlines() or ['']:
+                _capture_line(data, line.rstrip()) # Store for final log
+
+    def finish(data):
+        """Logs whatever trailed the last newline of a stream."""
+        for line in data["partial"].decode('utf-8', 'replace').splitlines():
+            _capture_line(data, line.rstrip())
+        data["partial"] = b''
 
     def read_stream(stream, data):
-        """Reads lines from a stream and prints them live."""
+        """Drains one stream on its own thread (used where pipes can't be selected on)."""
         try:
-            for line in iter(stream.readline, ''):
-                line_stripped = line.rstrip() # Keep original line ending for printing? No, strip for consistency.
-                print(line_stripped, flush=True) # Print live output
-                with data["lock"]:
-                    data["lines"].append(line_stripped) # Store for final log
+            for chunk in iter(lambda: stream.read1(4096), b''):
+                show(chunk) # Two writer threads; no shared batch buffer here
+                feed(data, chunk)
+            finish(data)
             stream.close()
         except Exception as e:
             # Handle potential errors during stream reading (e.g., decoding errors)
             error_message = f"[Stream reading error: {e}]"
             print(error_message, flush=True)
-            with data["lock"]:
-                data["lines"].append(error_message)
+            _capture_line(data, error_message)
 
 
     try:
@@ -476,28 +716,55 @@ def execute_terminal_command(command):
             command,
             shell=True,
             stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-            encoding='utf-8', # Be explicit about encoding
-            errors='replace', # Replace characters that cause decoding errors
-            bufsize=1 # Line-buffered
+            stderr=subprocess.PIPE # Binary pipes; output is decoded only for the final log
         )
 
-        stdout_thread = threading.Thread(target=read_stream, args=(process.stdout, stdout_data))
-        stderr_thread = threading.Thread(target=read_stream, args=(process.stderr, stderr_data))
+        if os.name == 'posix':
+            # Multiplex both pipes on this thread; no reader threads or cross-thread locking
+            with selectors.DefaultSelector() as sel:
+                sel.register(process.stdout, selectors.EVENT_READ, stdout_data)
+                sel.register(process.stderr, selectors.EVENT_READ, stderr_data)
+                last_flush = time.monotonic()
+                while sel.get_map():
+                    # Wake up in time to show batched output even if the command goes quiet
+                    timeout = max(0.0, LIVE_FLUSH_INTERVAL - (time.monotonic() - last_flush)) if live_pending else None
+                    for key, _ in sel.select(timeout):
+                        # os.read bypasses the pipe's buffer, so select() always sees pending data
+                        chunk = os.read(key.fd, 65536)
+                        if not chunk: # EOF
+                            sel.unregister(key.fileobj)
+                            finish(key.data)
+                            continue
+                        live_pending += chunk
+                        feed(key.data, chunk)
+                    now = time.monotonic()
+                    if len(live_pending) >= LIVE_FLUSH_BYTES or (live_pending and now - last_flush >= LIVE_FLUSH_INTERVAL):
+                        flush_live()
+                        last_flush = now
+                flush_live()
+        else:
+            # Windows can't select() on pipes; drain each one on its own thread
+            stdout_thread = threading.Thread(target=read_stream, args=(process.stdout, stdout_data))
+            stderr_thread = threading.Thread(target=read_stream, args=(process.stderr, stderr_data))
 
-        stdout_thread.start()
-        stderr_thread.start()
+            stdout_thread.start()
+            stderr_thread.start()
 
-        # Wait for threads to finish (means process streams are closed)
-        stdout_thread.join()
-        stderr_thread.join()
+            # Wait for threads to finish (means process streams are closed)
+            stdout_thread.join()
+            stderr_thread.join()
 
         # Wait for process to terminate and get return code
         process.wait()
         return_code = process.returncode
 
     except KeyboardInterrupt:
+        flush_live() # Show what the command printed before the interrupt
+        if os.name == 'posix':
+            # The selector loop stopped before EOF: log each stream's unterminated last line
+            # (often a prompt or progress line). Reader threads (Windows) do this themselves.
+            finish(stdout_data)
+            finish(stderr_data)
         print(f"\n{Fore.YELLOW}--- User Interrupt (Ctrl+C) Detected ---{Style.RESET_ALL}")
         interrupted = True
         if process:
@@ -522,6 +789,7 @@ def execute_terminal_command(command):
         return_code = -1 # Indicate general failure
 
     finally:
+        flush_live() # Never drop batched live output
         # Ensure streams are closed if process was started
         if process and process.stdout: process.stdout.close()
         if process and process.stderr: process.stderr.close()
@@ -534,56 +802,51 @@ def execute_terminal_command(command):
 
 
     # --- Prepare Logs ---
-    exec_log = [] # Log for the final box shown to user
-    ai_response_log = [] # Log formatted for AI consumption
+    # One list of (box line, AI line) pairs; the box shown to the user and the log sent to the AI
+    # are two views of it, so they can't drift apart. None leaves a line out of that view.
+    log = []
+    reset = Style.RESET_ALL
 
-    exec_log.append(f"{Style.BRIGHT}Command:{Style.RESET_ALL} {command}")
-    exec_log.append(H * visible_len(f"Command: {command}"))
-    ai_response_log.append(f"Command: {command}")
+    log.append((f"{Style.BRIGHT}Command:{reset} {command}", f"Command: {command}"))
+    log.append((H * visible_len(f"Command: {command}"), None))
 
     # Combine collected lines
-    output = "\n".join(stdout_data["lines"])
-    errors = "\n".join(stderr_data["lines"])
-
-    if output:
-        exec_log.append(f"{Fore.CYAN}--- Final Captured Output ---{Style.RESET_ALL}")
-        exec_log.extend(output.splitlines()) # Add each line separately
-        exec_log.append(f"{Fore.CYAN}---------------------------{Style.RESET_ALL}")
-        ai_response_log.append(f"--- STDOUT ---")
-        ai_response_log.extend(output.splitlines())
-        ai_response_log.append("-------------")
-
-    if errors:
-        exec_log.append(f"{Fore.RED}--- Final Captured Errors ---{Style.RESET_ALL}")
-        exec_log.extend(errors.splitlines())
-        exec_log.append(f"{Fore.RED}---------------------------{Style.RESET_ALL}")
-        ai_response_log.append(f"--- STDERR ---")
-        ai_response_log.extend(errors.splitlines())
-        ai_response_log.append("-------------")
+    output = _capture_text(stdout_data)
+    errors = _capture_text(stderr_data)
+
+    for text, color, box_header, ai_header in ((output, Fore.CYAN, "--- Final Captured Output ---", "--- STDOUT ---"),
+                                               (errors, Fore.RED, "--- Final Captured Errors ---", "--- STDERR ---")):
+        if text:
+            text_lines = text.splitlines() # Split once; each line appears unchanged in both views
+            log.append((f"{color}{box_header}{reset}", ai_header))
+            log.extend(zip(text_lines, text_lines))
+            log.append((f"{color}---------------------------{reset}", "-------------"))
 
     # Final status message
     if interrupted:
-         status_message_user = f"{Fore.YELLOW}⚠ Command Interrupted by User (Exit Code: {return_code}){Style.RESET_ALL}"
+         status_message_user = f"{Fore.YELLOW}⚠ Command Interrupted by User (Exit Code: {return_code}){reset}"
          status_message_ai = f"Exit Code: {return_code} (User Interrupted)"
          box_color = Fore.YELLOW
     elif return_code == 0:
-         status_message_user = f"{Fore.GREEN}✓ Command finished successfully (Exit Code: 0){Style.RESET_ALL}"
+         status_message_user = f"{Fore.GREEN}✓ Command finished successfully (Exit Code: 0){reset}"
          status_message_ai = f"Exit Code: 0 (Success)"
          box_color = Fore.GREEN
     elif return_code is None: # Should not happen often with Popen, maybe if Popen failed
-         status_message_user = f"{Fore.RED}✗ Command execution failed (Unknown Exit Code){Style.RESET_ALL}"
+         status_message_user = f"{Fore.RED}✗ Command execution failed (Unknown Exit Code){reset}"
          status_message_ai = f"Exit Code: Unknown (Error)"
          box_color = Fore.RED
     else:
-         status_message_user = f"{Fore.RED}✗ Command failed (Exit Code: {return_code}){Style.RESET_ALL}"
+         status_message_user = f"{Fore.RED}✗ Command failed (Exit Code: {return_code}){reset}"
          status_message_ai = f"Exit Code: {return_code} (Error)"
          box_color = Fore.RED
 
-    exec_log.append(status_message_user)
-    ai_response_log.append(status_message_ai)
+    log.append((status_message_user, status_message_ai))
+
+    exec_log = [box_line for box_line, _ in log if box_line is not None] # Log for the final box shown to user
+    ai_log = "\n".join(ai_line for _, ai_line in log if ai_line is not None) # Log formatted for AI consumption
 
     # Print execution log in a box
-    print_boxed(f"Final Execution Result", "\n".join(exec_log), color=box_color)
+    print_boxed(f"Final Execution Result", exec_log, color=box_color) # List form, no join/split round-trip
     print("-" * 30) # Separator after box
 
     # Return both the standard result and the AI-formatted log
@@ -592,68 +855,63 @@ def execute_terminal_command(command):
         "stderr": errors,
         "returncode": return_code,
         "interrupted": interrupted, # Add interrupted flag
-        "ai_log": "\n".join(ai_response_log)
+        "ai_log": ai_log
     }
 
 def strip_code_fences(content):
     """Removes leading/trailing markdown code fences (```lang...``` or ```...```)."""
-    # Pattern to match optional language and the fences
-    # Handles ```python ... ``` or ``` ... ```
-    pattern = r"^\s*```[\w]*\n?(.*?)?\n?```\s*$"
-    match = re.match(pattern, content, re.DOTALL | re.IGNORECASE)
+    stripped = content.strip()
+    if not stripped.startswith("```"): # Common case: no fence, so skip the regex entirely
+        return stripped
+    match = _CODE_FENCE_RE.fullmatch(stripped)
     if match:
         # Return the content inside the fences, stripping outer whitespace
-        return match.group(1).strip() if match.group(1) else ""
+        return match.group(1).strip()
     # If no fences found, just strip outer whitespace
-    return content.strip()
+    return stripped
 
 def parse_file_operations(response_text):
     """Parse the response text to extract file operations using the new format."""
     cleaned_response, _ = parse_end_response(response_text)
     cleaned_response = strip_code_fences(cleaned_response) # Pre-strip outer fences
 
+    # One scan collects every op, in the order they appear in the response
     file_operations = []
-
-    # --- CREATE Operation --- Use generic END.
-    create_pattern = r"^====== CREATE\s+([^\n]+)\n(.*?)\n====== END\s*$" # Changed CEND to END
-    for match in re.finditer(create_pattern, cleaned_response, re.DOTALL | re.MULTILINE | re.IGNORECASE):
-        filename = match.group(1).strip()
-        raw_content = match.group(2)
-        content = strip_code_fences(raw_content.strip())
-        if content:
-            file_operations.append({
-                "type": "create",
-                "filename": filename,
-                "content": content
-            })
-        else:
-             print(f"{Fore.YELLOW}Warning: Skipping CREATE operation for '{filename}' because content was empty after stripping.{Style.RESET_ALL}")
-
-    # --- New Block-Based REPLACE Operation --- Use generic END.
-    # Changed pattern to use six equals (======)
-    new_replace_pattern = r"^====== REPLACE\s+([^\n]+)\n(.*?)\n====== TO\n(.*?)\n====== END\s*$" # Changed REND to END
-
-    for match in re.finditer(new_replace_pattern, cleaned_response, re.DOTALL | re.MULTILINE | re.IGNORECASE):
-        filename = match.group(1).strip()
-        old_code_block = match.group(2)
-        new_code_block = match.group(3)
-
-        # Skip empty replacements
-        if not old_code_block.strip() or not new_code_block.strip():
-            print(f"{Fore.YELLOW}Warning: Skipping block REPLACE for '{filename}' because old or new code block was empty.{Style.RESET_ALL}")
-            continue
-
-        if not os.path.exists(filename):
-            print(f"{Fore.YELLOW}Warning: File '{filename}' does not exist for block REPLACE operation.{Style.RESET_ALL}")
-            continue
-
-        try:
-            with open(filename, 'r', encoding='utf-8') as f:
-                file_content = f.read()
-
-            # We need to verify that the old code block exists exactly in the file
-            old_code_lines = old_code_block.splitlines()
-            file_lines = file_content.splitlines()
+    is_file_cache = {} # filename -> os.path.isfile result, shared across REPLACE blocks in this response
+
+    for match in _FILE_OP_RE.finditer(cleaned_response):
+        op_kind = match.lastgroup # Last group of the alternative that matched: create_body / replace_new / rewrite_body
+        # --- CREATE Operation ---
+        if op_kind == "create_body":
+            filename = match.group("create_name").strip()
+            raw_content = match.group("create_body")
+            content = strip_code_fences(raw_content.strip())
+            if content:
+                file_operations.append({
+                    "type": "create",
+                    "filename": filename,
+                    "content": content
+                })
+            else:
+                 print(f"{Fore.YELLOW}Warning: Skipping CREATE operation for '{filename}' because content was empty after stripping.{Style.RESET_ALL}")
+
+        # --- New Block-Based REPLACE Operation ---
+        elif op_kind == "replace_new":
+            filename = match.group("replace_name").strip()
+            old_code_block = match.group("replace_old")
+            new_code_block = match.group("replace_new")
+
+            # Skip empty replacements
+            if not old_code_block.strip() or not new_code_block.strip():
+                print(f"{Fore.YELLOW}Warning: Skipping block REPLACE for '{filename}' because old or new code block was empty.{Style.RESET_ALL}")
+                continue
+
+            # Only check the file is there; reading it and matching old_code happen in the apply phase
+            if filename not in is_file_cache:
+                is_file_cache[filename] = os.path.isfile(filename)
+            if not is_file_cache[filename]:
+                print(f"{Fore.YELLOW}Warning: File '{filename}' does not exist for block REPLACE operation.{Style.RESET_ALL}")
+                continue
 
             # Create a special operation for block-based replacement
             file_operations.append({
@@ -664,65 +922,64 @@ def parse_file_operations(response_text):
                 "verified": False  # Will be set to True during apply phase if matched
             })
 
-        except Exception as e:
-            print(f"{Fore.RED}Error reading file '{filename}' for block REPLACE: {str(e)}{Style.RESET_ALL}")
-
-    # --- REWRITE Operation --- Use generic END.
-    rewrite_pattern = r"^====== REWRITE\s+([^\n]+)\n(.*?)\n====== END\s*$" # Changed WEND to END
-    for match in re.finditer(rewrite_pattern, cleaned_response, re.DOTALL | re.MULTILINE | re.IGNORECASE):
-        filename = match.group(1).strip()
-        raw_content = match.group(2)
-        # We don't need to strip code fences here because the instruction is to never use them inside
-        content = raw_content.strip()
-        if content: # Allow empty file rewrite?
-            file_operations.append({
-                "type": "rewrite",
-                "filename": filename,
-                "content": content
-            })
+        # --- REWRITE Operation ---
         else:
-            print(f"{Fore.YELLOW}Warning: Skipping REWRITE operation for '{filename}' because content was empty.{Style.RESET_ALL}")
-
+            filename = match.group("rewrite_name").strip()
+            raw_content = match.group("rewrite_body")
+            # We don't need to strip code fences here because the instruction is to never use them inside
+            content = raw_content.strip()
+            if content: # Allow empty file rewrite?
+                file_operations.append({
+                    "type": "rewrite",
+                    "filename": filename,
+                    "content": content
+                })
+            else:
+                print(f"{Fore.YELLOW}Warning: Skipping REWRITE operation for '{filename}' because content was empty.{Style.RESET_ALL}")
     return file_operations
 
 def show_diff(old_lines, new_lines):
     """Show colored diff between old and new content."""
-    import difflib
-    
-    diff = difflib.ndiff(old_lines, new_lines)
-    print(f"{Fore.MAGENTA}--- Diff Start ---{Style.RESET_ALL}")
-    for line in diff:
-        if line.startswith('+ '):
-            print(f"{Fore.GREEN}+{Style.RESET_ALL} {line[2:]}") # Green for additions
-        elif line.startswith('- '):
-            print(f"{Fore.RED}-{Style.RESET_ALL} {line[2:]}")   # Red for deletions
-        elif line.startswith('? '):
-            # Optionally show context hints in a different color
-            # print(f"{Fore.CYAN}{line}{Style.RESET_ALL}") 
+    # Opcodes instead of ndiff: no quadratic intraline pass and no '? ' hint lines to throw away
+    sm = difflib.SequenceMatcher(None, old_lines, new_lines, autojunk=False)
+    out = [f"{Fore.MAGENTA}--- Diff Start ---{Style.RESET_ALL}"]
+    removed = f"{Fore.RED}-{Style.RESET_ALL} %s"   # Red for deletions
+    added = f"{Fore.GREEN}+{Style.RESET_ALL} %s"   # Green for additions
+    for tag, i1, i2, j1, j2 in sm.get_opcodes():
+        if tag == 'equal':
+            out.extend(f"  {line}" for line in old_lines[i1:i2]) # Keep indentation for context lines
             continue
-        else:
-            print(f"  {line[2:]}") # Keep indentation for context lines
-    print(f"{Fore.MAGENTA}--- Diff End ---{Style.RESET_ALL}")
-
-def preview_changes(file_operations):
+        # 'replace' shows the removed lines, then the added ones (as ndiff did)
+        out.extend(removed % line for line in old_lines[i1:i2])
+        out.extend(added % line for line in new_lines[j1:j2])
+    out.append(f"{Fore.MAGENTA}--- Diff End ---{Style.RESET_ALL}")
+    sys.stdout.write("\n".join(out) + "\n") # One write for the whole diff
+
+# Per-line preview templates, formatted once at import instead of an f-string per previewed line
+_PREVIEW_CONTENT_LINE = f"{Fore.GREEN}  %s{Style.RESET_ALL}"
+_PREVIEW_REWRITE_LINE = f"{Fore.GREEN}  + %s{Style.RESET_ALL}" # Use + prefix for clarity
+_PREVIEW_OLD_LINE = f"{Fore.RED}- %s{Style.RESET_ALL}"
+_PREVIEW_NEW_LINE = f"{Fore.GREEN}+ %s{Style.RESET_ALL}"
+_PREVIEW_SEPARATOR = "-" * 30
+
+def preview_changes(file_operations, auto_confirm=False):
     """Preview changes to be made to files."""
     preview_content = [] # Collect content for the box
 
     if not file_operations:
         preview_content.append(f"{Fore.YELLOW}No file operations proposed.{Style.RESET_ALL}")
-        print_boxed("File Operations Preview", "\n".join(preview_content), color=Fore.YELLOW)
+        print_boxed("File Operations Preview", preview_content, color=Fore.YELLOW)
         return True # Nothing to confirm
 
     operations_present = False
     for op in file_operations:
         operations_present = True
-        preview_content.append("-" * 30) # Separator within the box content
+        preview_content.append(_PREVIEW_SEPARATOR) # Separator within the box content
         if op["type"] == "create":
             preview_content.append(f"{Style.BRIGHT}{Fore.GREEN}CREATE File:{Style.RESET_ALL} {Fore.WHITE}{op['filename']}{Style.RESET_ALL}")
             preview_content.append(f"{Fore.YELLOW}Content Preview (first 5 lines):{Style.RESET_ALL}")
             content_lines = op["content"].splitlines()
-            for line in content_lines[:5]:
-                 preview_content.append(f"{Fore.GREEN}  {line}{Style.RESET_ALL}")
+            preview_content.extend([_PREVIEW_CONTENT_LINE % line for line in content_lines[:5]])
             if len(content_lines) > 5:
                  preview_content.append(f"{Fore.GREEN}  ...{Style.RESET_ALL}")
             preview_content.append("") # Add empty line for spacing
@@ -737,8 +994,7 @@ def preview_changes(file_operations):
             
             # Show first few lines of old code
             max_preview_lines = min(5, len(old_code_lines))
-            for line in old_code_lines[:max_preview_lines]:
-                preview_content.append(f"{Fore.RED}- {line}{Style.RESET_ALL}")
+            preview_content.extend([_PREVIEW_OLD_LINE % line for line in old_code_lines[:max_preview_lines]])
             if len(old_code_lines) > max_preview_lines:
                 preview_content.append(f"{Fore.RED}- ...{Style.RESET_ALL}")
             
@@ -747,8 +1003,7 @@ def preview_changes(file_operations):
             # Show new code that will replace the old
             new_code_lines = op["new_code"].splitlines()
             max_preview_lines = min(5, len(new_code_lines))
-            for line in new_code_lines[:max_preview_lines]:
-                preview_content.append(f"{Fore.GREEN}+ {line}{Style.RESET_ALL}")
+            preview_content.extend([_PREVIEW_NEW_LINE % line for line in new_code_lines[:max_preview_lines]])
             if len(new_code_lines) > max_preview_lines:
                 preview_content.append(f"{Fore.GREEN}+ ...{Style.RESET_ALL}")
                 
@@ -761,8 +1016,7 @@ def preview_changes(file_operations):
             preview_content.append(f"{Style.BRIGHT}{Fore.RED}REWRITE File (Replace Entire Content):{Style.RESET_ALL} {Fore.WHITE}{op['filename']}{Style.RESET_ALL}")
             preview_content.append(f"{Fore.YELLOW}New Content Preview (first 5 lines):{Style.RESET_ALL}")
             content_lines = op["content"].splitlines()
-            for line in content_lines[:5]:
-                 preview_content.append(f"{Fore.GREEN}  + {line}{Style.RESET_ALL}") # Use + prefix for clarity
+            preview_content.extend([_PREVIEW_REWRITE_LINE % line for line in content_lines[:5]])
             if len(content_lines) > 5:
                  preview_content.append(f"{Fore.GREEN}  + ...{Style.RESET_ALL}")
             preview_content.append(f"{Fore.CYAN}(Total {len(content_lines)} lines){Style.RESET_ALL}")
@@ -770,13 +1024,16 @@ def preview_changes(file_operations):
 
     if not operations_present:
          preview_content.append(f"{Fore.YELLOW}No file operations were parsed from the response.{Style.RESET_ALL}")
-         print_boxed("File Operations Preview", "\n".join(preview_content), color=Fore.YELLOW)
+         print_boxed("File Operations Preview", preview_content, color=Fore.YELLOW)
          return True
 
     # Print the collected content inside a box
-    print_boxed("File Operations Preview", "\n".join(preview_content), color=Fore.CYAN)
+    print_boxed("File Operations Preview", preview_content, color=Fore.CYAN) # List form, no join/split round-trip
 
     print("-" * 30) # Separator outside the box before confirmation
+    if auto_confirm: # --yes: don't block on the prompt
+        print(f"{Fore.GREEN}Applying file changes (--yes).{Style.RESET_ALL}")
+        return True
     # Use startswith('y') for more robust check
     raw_confirm = input(f"{Style.BRIGHT}{Fore.CYAN}Apply these file changes? (y/n): {Style.RESET_ALL}")
     confirm = raw_confirm.lower().strip()
@@ -788,30 +1045,306 @@ def preview_changes(file_operations):
     # --- Changed Comparison ---
     return confirm.startswith('y')
 
-def apply_changes(file_operations):
-    """Apply the file operations."""
+# --- Apply log message templates (colors baked in once; fill with `%`) ---
+_LOG_CREATED = f"{Fore.GREEN}✓ SUCCESS:{Style.RESET_ALL} Created file {Fore.WHITE}%s{Style.RESET_ALL}"
+_LOG_REWROTE = f"{Fore.GREEN}✓ SUCCESS:{Style.RESET_ALL} Rewrote file {Fore.WHITE}%s{Style.RESET_ALL}"
+_LOG_REPLACED_BLOCK = f"{Fore.GREEN}✓ SUCCESS:{Style.RESET_ALL} Replaced code block in {Fore.WHITE}%s{Style.RESET_ALL}"
+_LOG_NO_MATCH = f"{Fore.RED}✗ NO MATCH:{Style.RESET_ALL} Could not find matching code block in {Fore.WHITE}%s{Style.RESET_ALL}"
+_LOG_BLOCK_NOT_FOUND = f"{Fore.RED}✗ FAILED:{Style.RESET_ALL} File {Fore.WHITE}%s{Style.RESET_ALL} not found for REPLACE BLOCK."
+_LOG_LINES_NOT_FOUND = f"{Fore.RED}✗ FAILED:{Style.RESET_ALL} File {Fore.WHITE}%s{Style.RESET_ALL} not found for REPLACE LINES."
+_LOG_BLOCK_ERROR = f"{Fore.RED}✗ FAILED:{Style.RESET_ALL} Error processing REPLACE BLOCK for {Fore.WHITE}%s{Style.RESET_ALL}: %s"
+_LOG_LINES_ERROR = f"{Fore.RED}✗ FAILED:{Style.RESET_ALL} Error processing REPLACE LINES for {Fore.WHITE}%s{Style.RESET_ALL}: %s"
+_LOG_CREATE_ERROR = f"{Fore.RED}✗ FAILED:{Style.RESET_ALL} Error creating file {Fore.WHITE}%s{Style.RESET_ALL}: %s"
+_LOG_REWRITE_ERROR = f"{Fore.RED}✗ FAILED:{Style.RESET_ALL} Error rewriting file {Fore.WHITE}%s{Style.RESET_ALL}: %s"
+_LOG_WRITE_ERROR = f"{Fore.RED}✗ FAILED:{Style.RESET_ALL} Error writing {Fore.WHITE}%s{Style.RESET_ALL}: %s"
+_LOG_ERROR_DETAIL = f"  {Fore.RED}%s: %s{Style.RESET_ALL}"
+
+def _log_exception_detail(apply_log, e):
+    """Adds the exception summary to the apply log; the full traceback only when CODAGENT_DEBUG is set."""
+    if DEBUG:
+        apply_log.extend(f"  {Fore.RED}{line}{Style.RESET_ALL}" for line in traceback.format_exc().splitlines())
+    else:
+        apply_log.append(_LOG_ERROR_DETAIL % (type(e).__name__, e)) # Last traceback line, without formatting the whole trace
+
+@functools.lru_cache(maxsize=None)
+def _ensure_parent_dir(dirname):
+    """Creates a directory (and parents) once per apply batch; the cache is cleared by apply_changes."""
+    os.makedirs(dirname, exist_ok=True)
+
+def _atomic_write(path, content, file_cache=None):
+    """Writes text to `path` via a temp file in the same directory and os.replace, so readers never see a partial file.
+
+    The written file is dropped from `file_cache` (see _read_text_cached), if one is given.
+    """
+    path = os.path.realpath(path) # Write through symlinks (as open(path, "w") did) instead of replacing the link
+    dirname = os.path.dirname(path)
+    _ensure_parent_dir(dirname)
+    try:
+        mode = stat.S_IMODE(os.stat(path).st_mode) # Keep the permissions of the file being replaced
+    except FileNotFoundError:
+        mode = None # New file: the 0o666 create mode below is masked by the umask, as with open(path, "w")
+    while True:
+        tmp_path = os.path.join(dirname, ".codagent-%s.tmp" % os.urandom(6).hex())
+        try:
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0), 0o666)
+            break
+        except FileExistsError:
+            continue # Name collision; pick another
+    try:
+        # Pre-encoded bytes in one write; no text-layer newline translation needed (content uses '\n')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content.encode('utf-8'))
+        if mode is not None:
+            os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+        if file_cache is not None:
+            file_cache.pop(path, None) # Keys are real paths, like `path` here
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+def _read_text(path):
+    """Reads a UTF-8 text file with one binary read and one decode; same result as a text-mode read()."""
+    with open(path, 'rb') as f:
+        text = f.read().decode('utf-8') # No incremental decoder or per-chunk newline translation
+    # Match text-mode reads (universal newlines)
+    if '\r' in text:
+        text = text.replace('\r\n', '\n').replace('\r', '\n')
+    return text
+
+def _read_text_cached(path, file_cache=None):
+    """Reads a file through `file_cache`, so re-reads in the same apply/retry cycle skip the read and decode.
+
+    `file_cache` maps real paths to ((mtime_ns, size), text). It is created by the caller of apply_changes,
+    shared with retry_failed_replacements, and cleared when that cycle ends; _atomic_write evicts what it writes.
+    """
+    if file_cache is None:
+        return _read_text(path)
+    key = os.path.realpath(path)
+    st = os.stat(key) # Raises FileNotFoundError like open() would
+    sig = (st.st_mtime_ns, st.st_size) # Also catches edits made outside CodAgent during the cycle
+    entry = file_cache.get(key)
+    if entry is not None and entry[0] == sig:
+        return entry[1]
+    text = _read_text(key)
+    file_cache[key] = (sig, text)
+    return text
+
+def apply_ops_for_file(filename, ops, apply_log, file_cache=None):
+    """Apply all block replacements for one file: read once, edit in memory, write once."""
+    successful_ops = []
+    failed_ops = []
+    try:
+        # Read the file content (open() raises FileNotFoundError itself, no separate exists() check)
+        file_content = _read_text_cached(filename, file_cache)
+    except Exception as e:
+        for op in ops:
+            if isinstance(e, FileNotFoundError):
+                apply_log.append(_LOG_BLOCK_NOT_FOUND % filename)
+            else:
+                apply_log.append(_LOG_BLOCK_ERROR % (filename, e))
+                _log_exception_detail(apply_log, e)
+            failed_ops.append(op)
+        return successful_ops, failed_ops
+
+    file_lines = None # Split lazily, and only re-split after the buffer changes
+    file_rs = None    # Right-stripped copy of file_lines used for whitespace-tolerant matching
+    file_norm = None  # file_rs joined as "\n<line>\n<line>...\n", for whole-block str.find lookups
+    matcher = None    # SequenceMatcher indexed on file_rs (line -> offsets), shared by every op on this file
+
+    for op in ops:
+        try:
+            # Get the old code and new code from the operation
+            old_code = op["old_code"]
+            new_code = op["new_code"]
+
+            # Check if old_code exists exactly in the file (with indentation) - single scan
+            match_idx = file_content.find(old_code)
+            if match_idx != -1:
+                # Perfect match found - splice the new code into the in-memory buffer (first occurrence only)
+                match_end = match_idx + len(old_code)
+                is_unique = file_content.find(old_code, match_idx + 1) == -1 # From idx+1 so overlapping repeats count too
+                file_content = file_content[:match_idx] + new_code + file_content[match_end:]
+                file_lines = None
+                file_rs = None
+                file_norm = None
+                matcher = None
+
+                apply_log.append(_LOG_REPLACED_BLOCK % filename)
+                if not is_unique:
+                    apply_log.append(f"{Fore.YELLOW}  Note: the block appears more than once; only the first occurrence was replaced.{Style.RESET_ALL}")
+                op["verified"] = True
+                successful_ops.append(op)
+            else:
+                # No exact match - need to analyze what doesn't match
+                old_code_lines = old_code.splitlines()
+                if file_lines is None:
+                    file_lines = file_content.splitlines()
+                    file_rs = [line.rstrip() for line in file_lines]
+                    file_norm = None
+                # rstrip each line once up front instead of inside the scoring loops
+                old_rs = [line.rstrip() for line in old_code_lines]
+
+                # Try to find where the block should be
+                potential_matches = []
+                if old_code_lines:
+                    # Fast path: the block differs only in trailing whitespace. One C-level find over the
+                    # line-normalized text locates it, with "\n" on both sides so it starts and ends on line boundaries.
+                    if file_norm is None:
+                        file_norm = "\n" + "\n".join(file_rs) + "\n"
+                    norm_idx = file_norm.find("\n" + "\n".join(old_rs) + "\n")
+                    if norm_idx != -1:
+                        potential_matches.append(file_norm.count("\n", 0, norm_idx)) # Newlines before it = its line index
+                if old_code_lines and not potential_matches:
+                    if matcher is None:
+                        # Index the file lines once; each op only swaps in its own old code
+                        matcher = difflib.SequenceMatcher(None, autojunk=False)
+                        matcher.set_seq2(file_rs)
+                    matcher.set_seq1(old_rs)
+                    # One longest-run search first: a strong anchor (a third of the block, at least 2 lines)
+                    # pins the window, even when the block's first line was edited
+                    anchor = matcher.find_longest_match(0, len(old_rs), 0, len(file_rs))
+                    if anchor.size >= max(2, len(old_rs) // 3):
+                        potential_matches.append(min(max(0, anchor.b - anchor.a), len(file_lines) - 1))
+                    else:
+                        # Weak anchor: align the whole block; every matching block
+                        # implies a candidate start line (file index - old code index)
+                        blocks = sorted(matcher.get_matching_blocks(), key=lambda block: block.size, reverse=True)
+                        for old_idx, file_idx, size in blocks:
+                            start_idx = file_idx - old_idx
+                            if size and 0 <= start_idx < len(file_lines) and start_idx not in potential_matches:
+                                potential_matches.append(start_idx)
+
+                # Score each candidate window (count of equal lines), largest aligned block first
+                best_match = None
+                best_match_score = 0
+
+                for start_idx in potential_matches:
+                    window_end = min(len(old_code_lines), len(file_lines) - start_idx)
+                    if window_end <= best_match_score:
+                        continue # Window too short (runs past end of file) to beat the current best
+                    match_score = sum(map(str.__eq__, file_rs[start_idx:start_idx + window_end], old_rs)) # Compared in C
+
+                    if match_score > best_match_score:
+                        best_match_score = match_score
+                        best_match = start_idx
+                        if best_match_score == len(old_code_lines):
+                            break # Perfect (whitespace-insensitive) match - nothing can beat it
+
+                # Collect the mismatching lines of the best window in a single pass
+                best_mismatches = []
+                if best_match is not None:
+                    for j in range(min(len(old_code_lines), len(file_lines) - best_match)):
+                        if file_rs[best_match + j] != old_rs[j]:
+                            best_mismatches.append({
+                                'file_line_num': best_match + j + 1,  # 1-indexed line number
+                                'file_line': file_lines[best_match + j],
+                                'old_code_line_num': j + 1,  # 1-indexed line number
+                                'old_code_line': old_code_lines[j]
+                            })
+
+                # If we found a reasonable match (>50% matching)
+                if best_match is not None and best_match_score > len(old_code_lines) / 2:
+                    match_percentage = (best_match_score / len(old_code_lines)) * 100
+                    
+                    # Log the mismatch information
+                    apply_log.append(f"{Fore.YELLOW}⚠ PARTIAL MATCH:{Style.RESET_ALL} Found {match_percentage:.1f}% match in {Fore.WHITE}{filename}{Style.RESET_ALL} at line {best_match + 1}")
+                    apply_log.append(f"{Fore.YELLOW}  The following lines don't match exactly (whitespace/indentation sensitive):{Style.RESET_ALL}")
+                    
+                    # File line, old code line and a blank spacer per mismatch, added in one extend
+                    apply_log.extend([
+                        line
+                        for m in best_mismatches
+                        for line in (
+                            f"{Fore.RED}  - File (L{m['file_line_num']}):{Style.RESET_ALL} {m['file_line']!r}",
+                            f"{Fore.RED}  - Old Code (L{m['old_code_line_num']}):{Style.RESET_ALL} {m['old_code_line']!r}",
+                            "",
+                        )
+                    ])
+                else:
+                    apply_log.append(_LOG_NO_MATCH % filename)
+                    
+                # Generate a more detailed diff report if a partial match was found
+                diff_report = ""
+                if best_match is not None:
+                    diff_report = generate_diff_report(file_lines, old_code_lines, file_rs, old_rs, best_match)
+                
+                # Mark as failed with detailed information for retry
+                op["match_details"] = {
+                    "has_match": best_match is not None,
+                    "match_line": best_match + 1 if best_match is not None else None,
+                    "match_score": best_match_score,
+                    "total_lines": len(old_code_lines),
+                    "mismatches": best_mismatches,
+                    "diff_report": diff_report # Add the detailed diff
+                }
+                failed_ops.append(op)
+        except Exception as e:
+            apply_log.append(_LOG_BLOCK_ERROR % (filename, e))
+            _log_exception_detail(apply_log, e)
+            failed_ops.append(op)
+
+    # Write the modified content back to the file once
+    write_failed = False
+    if successful_ops:
+        try:
+            _atomic_write(filename, file_content, file_cache)
+        except Exception as e:
+            apply_log.append(_LOG_WRITE_ERROR % (filename, e))
+            for op in successful_ops:
+                op["verified"] = False
+            failed_ops.extend(successful_ops)
+            successful_ops = []
+            write_failed = True
+
+    # Hand the final lines to failed ops so the retry prompt doesn't have to re-read the file
+    if failed_ops and not write_failed:
+        if file_lines is None:
+            file_lines = file_content.splitlines()
+        for op in failed_ops:
+            op["_cached_file_lines"] = file_lines
+            op["_cached_file_rs"] = file_rs # Right-stripped twin; None if the buffer changed after the last fuzzy match
+
+    return successful_ops, failed_ops
+
+def apply_changes(file_operations, file_cache=None):
+    """Apply the file operations. `file_cache` (see _read_text_cached) can be shared with the retry that follows."""
     failed_ops = []
     successful_ops = []
     apply_log = [] # Collect log messages for the box
+    _ensure_parent_dir.cache_clear() # Directories may have been removed since the last batch
+
+    # Group block replacements by file so a file is read and written once per group. A group only
+    # spans replace_blocks with no other op on that file in between: a CREATE/REWRITE/line edit of
+    # the same file closes it, so every op still takes effect in response order.
+    block_groups = {} # index of a group's first op -> all ops in the group
+    open_groups = {}  # filename -> the group still accepting replace_blocks
+    for idx, op in enumerate(file_operations):
+        if op["type"] == "replace_block":
+            group = open_groups.get(op['filename'])
+            if group is None:
+                group = block_groups[idx] = open_groups[op['filename']] = []
+            group.append(op)
+        else:
+            open_groups.pop(op['filename'], None)
 
-    for op in file_operations:
+    for idx, op in enumerate(file_operations):
         filename = op['filename']
         
         # Create file operation - existing logic
         if op["type"] == "create":
             # ... existing code ...
             try:
-                # Create parent directories if needed
-                os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
-                # Write the file
-                with open(filename, "w", newline='\n') as f:
-                    f.write(op["content"])
-                apply_log.append(f"{Fore.GREEN}✓ SUCCESS:{Style.RESET_ALL} Created file {Fore.WHITE}{filename}{Style.RESET_ALL}")
+                # Write the file atomically (parent directories are created if needed)
+                _atomic_write(filename, op["content"], file_cache)
+                apply_log.append(_LOG_CREATED % filename)
                 successful_ops.append(op)
             except Exception as e:
-                apply_log.append(f"{Fore.RED}✗ FAILED:{Style.RESET_ALL} Error creating file {Fore.WHITE}{filename}{Style.RESET_ALL}: {e}")
-                import traceback
-                apply_log.append(f"  {Fore.RED}{traceback.format_exc().splitlines()[-1]}{Style.RESET_ALL}")
+                apply_log.append(_LOG_CREATE_ERROR % (filename, e))
+                _log_exception_detail(apply_log, e)
                 failed_ops.append(op)
                 
         # Line-based replace operation - existing logic
@@ -819,16 +1352,11 @@ def apply_changes(file_operations):
             # ... existing code ...
             try:
                 # Check if file exists first
-                if not os.path.exists(filename):
-                    raise FileNotFoundError(f"File {filename} not found")
-                
-                # Open and read the file
-                with open(filename, 'r', encoding='utf-8') as f:
-                    original_lines_with_endings = f.readlines()  # Keep line endings
-                    original_content = f.read()
+                # Open and read the file (raises FileNotFoundError if missing)
+                original_content = _read_text_cached(filename, file_cache)
                 
-                # Strip line endings to work with the content
-                original_lines = [line.rstrip('\r\n') for line in original_lines_with_endings]
+                # Split once; splitlines() already drops the line endings
+                original_lines = original_content.splitlines()
                 num_original_lines = len(original_lines)
                 
                 # Maps for tracking operations - key is line number (1-based)
@@ -863,166 +1391,85 @@ def apply_changes(file_operations):
                         apply_log.append(f"  {Fore.RED}{detail}{Style.RESET_ALL}")
                     failed_ops.append(op)
 
-            except FileNotFoundError:
-                apply_log.append(f"{Fore.RED}✗ FAILED:{Style.RESET_ALL} File {Fore.WHITE}{filename}{Style.RESET_ALL} not found for REPLACE LINES.")
-                failed_ops.append(op)
             except Exception as e:
-                apply_log.append(f"{Fore.RED}✗ FAILED:{Style.RESET_ALL} Error processing REPLACE LINES for {Fore.WHITE}{filename}{Style.RESET_ALL}: {e}")
-                import traceback
-                apply_log.append(f"  {Fore.RED}{traceback.format_exc().splitlines()[-1]}{Style.RESET_ALL}")
+                if isinstance(e, FileNotFoundError):
+                    apply_log.append(_LOG_LINES_NOT_FOUND % filename)
+                else:
+                    apply_log.append(_LOG_LINES_ERROR % (filename, e))
+                    _log_exception_detail(apply_log, e)
                 failed_ops.append(op)
                 
         # --- Block-based replace operation - new logic ---
         elif op["type"] == "replace_block":
-            try:
-                if not os.path.exists(filename):
-                    raise FileNotFoundError(f"File {filename} not found")
-                    
-                # Read the file content
-                with open(filename, 'r', encoding='utf-8') as f:
-                    file_content = f.read()
-                
-                # Get the old code and new code from the operation
-                old_code = op["old_code"]
-                new_code = op["new_code"]
-                
-                # Check if old_code exists exactly in the file (with indentation)
-                if old_code in file_content:
-                    # Perfect match found - replace directly
-                    new_content = file_content.replace(old_code, new_code)
-                    
-                    # Write the modified content back to the file
-                    with open(filename, 'w', newline='\n') as f:
-                        f.write(new_content)
-                        
-                    apply_log.append(f"{Fore.GREEN}✓ SUCCESS:{Style.RESET_ALL} Replaced code block in {Fore.WHITE}{filename}{Style.RESET_ALL}")
-                    op["verified"] = True
-                    successful_ops.append(op)
-                else:
-                    # No exact match - need to analyze what doesn't match
-                    old_code_lines = old_code.splitlines()
-                    file_lines = file_content.splitlines()
-                    
-                    # Try to find where the block should be
-                    # First, find all potential starting points by matching the first line
-                    potential_matches = []
-                    
-                    if old_code_lines:
-                        for i in range(len(file_lines) - len(old_code_lines) + 1):
-                            if file_lines[i].rstrip() == old_code_lines[0].rstrip():
-                                potential_matches.append(i)
-                    
-                    # For each potential match, check the whole block
-                    best_match = None
-                    best_match_score = 0
-                    best_mismatches = []
-                    
-                    for start_idx in potential_matches:
-                        match_score = 0
-                        current_mismatches = []
-                        
-                        for j in range(len(old_code_lines)):
-                            if start_idx + j < len(file_lines):
-                                if file_lines[start_idx + j].rstrip() == old_code_lines[j].rstrip():
-                                    match_score += 1
-                                else:
-                                    current_mismatches.append({
-                                        'file_line_num': start_idx + j + 1,  # 1-indexed line number
-                                        'file_line': file_lines[start_idx + j],
-                                        'old_code_line_num': j + 1,  # 1-indexed line number
-                                        'old_code_line': old_code_lines[j]
-                                    })
-                        
-                        if match_score > best_match_score:
-                            best_match_score = match_score
-                            best_match = start_idx
-                            best_mismatches = current_mismatches
-                    
-                    # If we found a reasonable match (>50% matching)
-                    if best_match is not None and best_match_score > len(old_code_lines) / 2:
-                        match_percentage = (best_match_score / len(old_code_lines)) * 100
-                        
-                        # Log the mismatch information
-                        apply_log.append(f"{Fore.YELLOW}⚠ PARTIAL MATCH:{Style.RESET_ALL} Found {match_percentage:.1f}% match in {Fore.WHITE}{filename}{Style.RESET_ALL} at line {best_match + 1}")
-                        apply_log.append(f"{Fore.YELLOW}  The following lines don't match exactly (whitespace/indentation sensitive):{Style.RESET_ALL}")
-                        
-                        for mismatch in best_mismatches:
-                            apply_log.append(f"{Fore.RED}  - File (L{mismatch['file_line_num']}):{Style.RESET_ALL} {repr(mismatch['file_line'])}")
-                            apply_log.append(f"{Fore.RED}  - Old Code (L{mismatch['old_code_line_num']}):{Style.RESET_ALL} {repr(mismatch['old_code_line'])}")
-                            apply_log.append("")  # Empty line for readability
-                    else:
-                        apply_log.append(f"{Fore.RED}✗ NO MATCH:{Style.RESET_ALL} Could not find matching code block in {Fore.WHITE}{filename}{Style.RESET_ALL}")
-                        
-                    # Generate a more detailed diff report if a partial match was found
-                    diff_report = ""
-                    if best_match is not None:
-                        diff_report = generate_diff_report(file_lines, old_code_lines, best_match)
-                    
-                    # Mark as failed with detailed information for retry
-                    op["match_details"] = {
-                        "has_match": best_match is not None,
-                        "match_line": best_match + 1 if best_match is not None else None,
-                        "match_score": best_match_score,
-                        "total_lines": len(old_code_lines),
-                        "mismatches": best_mismatches,
-                        "diff_report": diff_report # Add the detailed diff
-                    }
-                    failed_ops.append(op)
-            
-            except FileNotFoundError:
-                apply_log.append(f"{Fore.RED}✗ FAILED:{Style.RESET_ALL} File {Fore.WHITE}{filename}{Style.RESET_ALL} not found for REPLACE BLOCK.")
-                failed_ops.append(op)
-            except Exception as e:
-                apply_log.append(f"{Fore.RED}✗ FAILED:{Style.RESET_ALL} Error processing REPLACE BLOCK for {Fore.WHITE}{filename}{Style.RESET_ALL}: {e}")
-                import traceback
-                apply_log.append(f"  {Fore.RED}{traceback.format_exc().splitlines()[-1]}{Style.RESET_ALL}")
-                failed_ops.append(op)
+            # Each group of block replacements is applied together on one in-memory buffer
+            group = block_groups.get(idx)
+            if group is None:
+                continue # Already applied with the group that starts earlier
+            block_successful, block_failed = apply_ops_for_file(filename, group, apply_log, file_cache)
+            successful_ops.extend(block_successful)
+            failed_ops.extend(block_failed)
 
         # --- REWRITE operation - new logic ---
         elif op["type"] == "rewrite":
             try:
-                # Create parent directories if they don't exist
-                os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
-                # Overwrite the file completely
-                with open(filename, "w", newline='\n') as f:
-                    f.write(op["content"])
-                apply_log.append(f"{Fore.GREEN}✓ SUCCESS:{Style.RESET_ALL} Rewrote file {Fore.WHITE}{filename}{Style.RESET_ALL}")
+                # Overwrite the file completely (atomically; parent directories are created if needed)
+                _atomic_write(filename, op["content"], file_cache)
+                apply_log.append(_LOG_REWROTE % filename)
                 successful_ops.append(op)
             except Exception as e:
-                apply_log.append(f"{Fore.RED}✗ FAILED:{Style.RESET_ALL} Error rewriting file {Fore.WHITE}{filename}{Style.RESET_ALL}: {e}")
-                import traceback
-                apply_log.append(f"  {Fore.RED}{traceback.format_exc().splitlines()[-1]}{Style.RESET_ALL}")
+                apply_log.append(_LOG_REWRITE_ERROR % (filename, e))
+                _log_exception_detail(apply_log, e)
                 failed_ops.append(op)
 
     # Print the apply log inside a box
     box_color = Fore.RED if failed_ops else Fore.GREEN
-    print_boxed("Applying File Operations Results", "\n".join(apply_log), color=box_color)
+    print_boxed("Applying File Operations Results", apply_log, color=box_color)
 
     return {"successful": successful_ops, "failed": failed_ops}
 
+def _read_text_mmap(path, sniff_size=4096):
+    """Reads a UTF-8 text file through mmap; returns None if a NUL byte in the first block marks it as binary."""
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return "" # mmap can't map empty files
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if b'\x00' in mm[:sniff_size]:
+                return None
+            text = mm[:].decode('utf-8')
+    # Match text-mode reads (universal newlines), as _read_text does
+    if '\r' in text:
+        text = text.replace('\r\n', '\n').replace('\r', '\n')
+    return text
+
 def process_add_command(target):
     """Process the /add command to include file or directory content."""
-    if not os.path.exists(target):
+    try:
+        target_mode = os.stat(target).st_mode # One stat answers exists / is-file / is-dir
+    except OSError:
         print(f"{Fore.RED}Error: {target} does not exist.{Style.RESET_ALL}")
         return None
     
     content = []
     
-    if os.path.isfile(target):
+    if stat.S_ISREG(target_mode):
         # Single file
         try:
-            with open(target, 'r', encoding='utf-8') as f:
-                file_content = f.read()
-            content.append(f"**File: {target}**\n```\n{file_content}\n```\n")
+            file_content = _read_text_mmap(target)
+            if file_content is None:
+                print(f"{Fore.YELLOW}Warning: {target} appears to be a binary file and cannot be read as text.{Style.RESET_ALL}")
+            else:
+                content.extend(("**File: ", target, "**\n```\n", file_content, "\n```\n"))
             
         except UnicodeDecodeError:
             print(f"{Fore.YELLOW}Warning: {target} appears to be a binary file and cannot be read as text.{Style.RESET_ALL}")
         except Exception as e:
             print(f"{Fore.RED}Error reading {target}: {e}{Style.RESET_ALL}")
     
-    elif os.path.isdir(target):
+    elif stat.S_ISDIR(target_mode):
         # Directory - only add files, not subdirectories
-        files = [f for f in glob.glob(os.path.join(target, '*')) if os.path.isfile(f)]
+        # scandir's DirEntry caches the file type, so no extra stat per entry (dotfiles skipped like glob's '*')
+        with os.scandir(target) as entries:
+            files = sorted(entry.path for entry in entries if not entry.name.startswith('.') and entry.is_file())
         
         if not files:
             print(f"{Fore.YELLOW}No files found in {target}.{Style.RESET_ALL}")
@@ -1032,9 +1479,14 @@ def process_add_command(target):
         
         for file_path in files:
             try:
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    file_content = f.read()
-                content.append(f"**File: {file_path}**\n```\n{file_content}\n```\n")
+                file_content = _read_text_mmap(file_path)
+                if file_content is None:
+                    print(f"{Fore.YELLOW}Warning: Skipping {file_path} (appears to be a binary file).{Style.RESET_ALL}")
+                    continue
+                if content:
+                    content.append("\n") # Blank line between files
+                # Keep the (possibly large) file text as its own fragment instead of copying it into an f-string
+                content.extend(("**File: ", file_path, "**\n```\n", file_content, "\n```\n"))
                 
             except UnicodeDecodeError:
                 print(f"{Fore.YELLOW}Warning: Skipping {file_path} (appears to be a binary file).{Style.RESET_ALL}")
@@ -1045,88 +1497,101 @@ def process_add_command(target):
         print(f"{Fore.YELLOW}No readable content found.{Style.RESET_ALL}")
         return None
     
-    return "\n".join(content)
-
-def _format_content_with_lines(content):
-    """Helper function to prepend line numbers to content."""
-    # REMOVED: Line numbering logic
-    # lines = content.splitlines()
-    # numbered_lines = [f"{i+1} | {line}" for i, line in enumerate(lines)]
-    # return "\n".join(numbered_lines)
-    # RETURN: Original content without modification
-    return content
+    return "".join(content)
+
+# --- Static lines of the file context block (built once, reused every turn) ---
+_FILE_CONTEXT_HEADER = f"{Style.BRIGHT}{Fore.MAGENTA}--- FILE CONTEXT (File List Only) ---{Style.RESET_ALL}" # Updated header
+_FILE_CONTEXT_FOOTER = f"{Style.BRIGHT}{Fore.MAGENTA}--- END FILE CONTEXT (Use @mention or ASK_FOR_FILES to load content) ---{Style.RESET_ALL}" # Updated footer
+_FILE_CONTEXT_CREATED_TITLE = f"\n{Fore.GREEN}Files CREATED this session:{Style.RESET_ALL}"
+_FILE_CONTEXT_MODIFIED_TITLE = f"\n{Fore.YELLOW}Files MODIFIED this session:{Style.RESET_ALL}"
+_FILE_CONTEXT_AVAILABLE_TITLE = f"\n{Fore.BLUE}Files AVAILABLE in workspace (content NOT loaded):{Style.RESET_ALL}" # Updated title
+_FILE_CONTEXT_ENTRY = f"- {Fore.WHITE}%s{Style.RESET_ALL}"
+_FILE_CONTEXT_NO_FILES = f"{Fore.CYAN}No files detected in workspace.{Style.RESET_ALL}" # Updated message
+_FILE_CONTEXT_TRAILER = (
+    f"\n{Fore.YELLOW}Use @mention or ASK_FOR_FILES to load specific file content.{Style.RESET_ALL}", # Emphasize loading
+    # CRITICAL warning about using correct filenames and file availability
+    f"\n{Fore.RED}⚠️ CRITICAL:{Style.RESET_ALL} Always use exact filenames from the lists above.",
+    f"{Fore.RED}⚠️ IMPORTANT:{Style.RESET_ALL} File content is NOT included below. You MUST use @mention or ASK_FOR_FILES to view content before modifying.", # Updated warning
+    _FILE_CONTEXT_FOOTER,
+)
+# [workspace, size, rendered entry lines] of the last workspace listing; entries are only ever added, so size is a valid version
+_WORKSPACE_LISTING = [None, -1, ()]
 
 def generate_file_context(file_history):
     """Generate a context string listing files in the session and workspace."""
-    context_lines = []
+    context_lines = [_FILE_CONTEXT_HEADER]
 
     # Add information about files created in this session
     if file_history["created"]:
-        context_lines.append(f"\n{Fore.GREEN}Files CREATED this session:{Style.RESET_ALL}")
+        context_lines.append(_FILE_CONTEXT_CREATED_TITLE)
         for file in file_history["created"]:
-            context_lines.append(f"- {Fore.WHITE}{file}{Style.RESET_ALL}")
+            context_lines.append(_FILE_CONTEXT_ENTRY % file)
 
     # Add information about files modified in this session
     if file_history["modified"]:
-        context_lines.append(f"\n{Fore.YELLOW}Files MODIFIED this session:{Style.RESET_ALL}")
+        context_lines.append(_FILE_CONTEXT_MODIFIED_TITLE)
         for file in file_history["modified"]:
-            context_lines.append(f"- {Fore.WHITE}{file}{Style.RESET_ALL}")
+            context_lines.append(_FILE_CONTEXT_ENTRY % file)
 
     # Add information about all files in workspace
-    context_lines.append(f"\n{Fore.BLUE}Files AVAILABLE in workspace (content NOT loaded):{Style.RESET_ALL}") # Updated title
-    files_available = sorted(list(set(file_history["current_workspace"])))
-    if files_available:
-        for file in files_available:
-            context_lines.append(f"- {Fore.WHITE}{file}{Style.RESET_ALL}")
-    else:
-        context_lines.append(f"{Fore.CYAN}No files detected in workspace.{Style.RESET_ALL}") # Updated message
-
-    context_lines.append(f"\n{Fore.YELLOW}Use @mention or ASK_FOR_FILES to load specific file content.{Style.RESET_ALL}") # Emphasize loading
-
-    # Add CRITICAL warning about using correct filenames and file availability
-    context_lines.append(f"\n{Fore.RED}⚠️ CRITICAL:{Style.RESET_ALL} Always use exact filenames from the lists above.")
-    context_lines.append(f"{Fore.RED}⚠️ IMPORTANT:{Style.RESET_ALL} File content is NOT included below. You MUST use @mention or ASK_FOR_FILES to view content before modifying.") # Updated warning
+    context_lines.append(_FILE_CONTEXT_AVAILABLE_TITLE)
+    workspace = file_history["current_workspace"]
+    if _WORKSPACE_LISTING[0] is not workspace or _WORKSPACE_LISTING[1] != len(workspace):
+        # Only re-sort and re-render when files were added; edits to known files reuse the listing
+        files_available = sorted(workspace) # Already unique
+        _WORKSPACE_LISTING[:] = [workspace, len(workspace), [_FILE_CONTEXT_ENTRY % file for file in files_available] or [_FILE_CONTEXT_NO_FILES]]
+    context_lines.extend(_WORKSPACE_LISTING[2])
 
     # --- REMOVED SECTION THAT READ AND INCLUDED FILE CONTENTS ---
 
-    # Return the formatted context string
-    context_header = f"{Style.BRIGHT}{Fore.MAGENTA}--- FILE CONTEXT (File List Only) ---{Style.RESET_ALL}\n" # Updated header
-    context_footer = f"\n{Style.BRIGHT}{Fore.MAGENTA}--- END FILE CONTEXT (Use @mention or ASK_FOR_FILES to load content) ---{Style.RESET_ALL}" # Updated footer
-    return context_header + "\n".join(context_lines) + context_footer
+    # Usage hints, warnings and footer, then assemble everything with a single join
+    context_lines.extend(_FILE_CONTEXT_TRAILER)
+    return "\n".join(context_lines)
 
-def generate_diff_report(file_lines, ai_old_code_lines, best_match_start_line):
-    """Generates a diff-like report comparing AI's old code and actual file lines."""
-    report = []
-    file_slice = file_lines[best_match_start_line : best_match_start_line + len(ai_old_code_lines)]
-    diff = difflib.ndiff(file_slice, ai_old_code_lines)
-    
-    report.append("--- Diff Report (File vs. Your Attempted Old Code) ---")
-    for i, line in enumerate(diff):
-        file_line_num = best_match_start_line + i + 1
-        prefix = line[:2]
-        content = line[2:]
-        if prefix == '+ ': # Lines only in AI's code (shouldn't happen if copied?)
-            report.append(f"AI Only (?): {repr(content)}") 
-        elif prefix == '- ': # Lines only in File code
-            report.append(f"File (L{file_line_num}):  {repr(content)}")
-        elif prefix == '  ': # Lines matching
-            report.append(f"Match (L{file_line_num}): {repr(content)}")
-        elif prefix == '? ': # Difference hints
-            # report.append(f"Hint:         {content}") # Optional: Show hints 
-            pass
+def generate_diff_report(file_lines, ai_old_code_lines, file_rs, old_rs, best_match_start_line):
+    """Generates a diff-like report comparing AI's old code and actual file lines.
+
+    Aligns the window with SequenceMatcher opcodes on the rstripped arrays already built by the matcher,
+    so a missing or extra line doesn't shift every line after it into a mismatch.
+    """
+    report = ["--- Diff Report (File vs. Your Attempted Old Code) ---"]
+    window_end = best_match_start_line + len(ai_old_code_lines)
+    file_window = file_lines[best_match_start_line:window_end]
+    sm = difflib.SequenceMatcher(None, file_rs[best_match_start_line:window_end], old_rs, autojunk=False)
+    for tag, i1, i2, j1, j2 in sm.get_opcodes():
+        if tag == 'equal': # Same once trailing whitespace is ignored
+            for i, j in zip(range(i1, i2), range(j1, j2)):
+                file_line_num = best_match_start_line + i + 1
+                if file_window[i] == ai_old_code_lines[j]: # Lines matching
+                    report.append(f"Match (L{file_line_num}): {repr(file_window[i])}")
+                else:
+                    report.append(f"File (L{file_line_num}):  {repr(file_window[i])}  (trailing whitespace differs)")
+                    report.append(f"AI Only (?): {repr(ai_old_code_lines[j])}")
+            continue
+        # replace / delete / insert: file side first, then what the AI sent instead
+        report.extend("File (L%d):  %r" % (best_match_start_line + i + 1, file_window[i]) for i in range(i1, i2)) # Lines in File code
+        report.extend("AI Only (?): %r" % (line,) for line in ai_old_code_lines[j1:j2]) # Also covers old code running past the end of the file
     report.append("------------------------------------------------------")
     return "\n".join(report)
 
-def retry_failed_replacements(failed_ops, client_or_model, provider, model_name, file_history, conversation_history, max_retries=2): # Updated signature
-    """Attempts to automatically retry failed REPLACE operations."""
+# Failed op types the auto-retry loop can re-prompt for
+_RETRYABLE_TYPES = frozenset(('replace_lines', 'replace_block'))
+
+def retry_failed_replacements(failed_ops, client_or_model, provider, model_name, file_history, conversation_history, max_retries=2, file_cache=None): # Updated signature
+    """Attempts to automatically retry failed REPLACE operations. `file_cache` is the one the failed apply_changes call used."""
     retry_attempt = 1
     # Filter for retryable failures - now includes both replace_lines and replace_block types
-    remaining_failed = [op for op in failed_ops if op.get('type') in ['replace_lines', 'replace_block']]
+    remaining_failed = []
     newly_successful = []
-    final_failed = [op for op in failed_ops if op.get('type') not in ['replace_lines', 'replace_block']] # Pass non-retryable failures through
+    final_failed = [] # Non-retryable failures are passed through
+    for op in failed_ops: # One pass partitions the failures
+        (remaining_failed if op.get('type') in _RETRYABLE_TYPES else final_failed).append(op)
 
     # For block replacements, limit retries to 10 attempts
     max_block_retries = 10
+
+    # file_history isn't updated until the caller processes our result, so the context is built once
+    retry_file_context = generate_file_context(file_history)
     
     while remaining_failed and retry_attempt <= max(max_retries, max_block_retries):
         print(f"\n{Fore.YELLOW}--- Attempting Auto-Retry {retry_attempt}/{max(max_retries, max_block_retries)} for Failed Replacements ---{Style.RESET_ALL}")
@@ -1151,8 +1616,12 @@ def retry_failed_replacements(failed_ops, client_or_model, provider, model_name,
                 filename = op['filename']
                 actual_code_segment = ""
                 try:
-                    with open(filename, 'r') as f:
-                        file_lines = f.read().splitlines()
+                    # Use the lines cached by apply_changes once; later attempts re-read (the file may have changed)
+                    file_lines = op.pop("_cached_file_lines", None)
+                    file_rs = op.pop("_cached_file_rs", None)
+                    if file_lines is None:
+                        file_lines = _read_text_cached(filename, file_cache).splitlines()
+                        file_rs = None
                     
                     start_line_idx = -1
                     # Try finding based on the partial match line first
@@ -1164,10 +1633,17 @@ def retry_failed_replacements(failed_ops, client_or_model, provider, model_name,
                         original_old_lines = op.get('old_code', '').splitlines()
                         if original_old_lines:
                              first_line = original_old_lines[0].rstrip()
-                             for i, line in enumerate(file_lines):
-                                 if line.rstrip() == first_line:
-                                      start_line_idx = i
-                                      break
+                             if file_rs is not None:
+                                 # Lines were already right-stripped while matching; search them in C
+                                 try:
+                                     start_line_idx = file_rs.index(first_line)
+                                 except ValueError:
+                                     pass
+                             else:
+                                 for i, line in enumerate(file_lines):
+                                     if line.rstrip() == first_line:
+                                          start_line_idx = i
+                                          break
                                       
                     # Extract the segment if found
                     if start_line_idx != -1:
@@ -1209,7 +1685,7 @@ def retry_failed_replacements(failed_ops, client_or_model, provider, model_name,
         # --- Simplified and Focused Retry Prompt --- 
         retry_message = "\n".join(retry_message_parts)
         simplified_retry_prompt_parts = [
-            generate_file_context(file_history), # Keep file context for overall reference
+            retry_file_context, # Keep file context for overall reference
             f"{Fore.RED}{Style.BRIGHT}{retry_message}{Style.RESET_ALL}"
         ]
         full_retry_prompt = "\n\n".join(simplified_retry_prompt_parts)
@@ -1256,36 +1732,37 @@ def retry_failed_replacements(failed_ops, client_or_model, provider, model_name,
 
         # --- Process Retry Response ---
         retry_file_ops = parse_file_operations(retry_response_text)
-        ops_to_apply_this_retry = []
+        retry_block_ops = [] # Block replacements go first as they're more targeted
+        retry_line_ops = []
         invalid_retry_ops = []
         
+        # Filenames of the ops we asked about, for O(1) membership checks below
+        block_failed_files = {op['filename'] for op in block_replace_ops}
+        line_failed_files = {op['filename'] for op in remaining_failed if op.get('type') == 'replace_lines'}
+
         # Filter and validate retry operations
         for retry_op in retry_file_ops:
             # Check block replaces for empty old_code (which caused the hallucination)
             if retry_op.get('type') == 'replace_block':
-                original_failed_op = next((failed_op for failed_op in block_replace_ops if failed_op['filename'] == retry_op['filename']), None)
-                if original_failed_op: # Make sure it corresponds to a failed op we asked about
+                if retry_op['filename'] in block_failed_files: # Make sure it corresponds to a failed op we asked about
                     if not retry_op.get('old_code', '').strip():
                         print(f"{Fore.RED}✗ Invalid Retry: AI provided empty old_code block for {retry_op['filename']}. Skipping this attempt.{Style.RESET_ALL}")
                         invalid_retry_ops.append(retry_op) # Track invalid attempt
                         continue # Skip this invalid operation
                     else:
-                        ops_to_apply_this_retry.append(retry_op)
+                        retry_block_ops.append(retry_op)
             # Include line replacements if they are valid (assuming parse_file_operations handles basic structure)
             elif retry_op.get('type') == 'replace_lines':
-                 line_replace_ops = [op for op in remaining_failed if op.get('type') == 'replace_lines']
-                 original_failed_op = next((failed_op for failed_op in line_replace_ops if failed_op['filename'] == retry_op['filename']), None)
-                 if original_failed_op: 
-                     ops_to_apply_this_retry.append(retry_op)
+                 if retry_op['filename'] in line_failed_files:
+                     retry_line_ops.append(retry_op)
 
-        # Sort the operations by type - we want to process block replacements first as they're more targeted
-        ops_to_apply_this_retry.sort(key=lambda x: 0 if x.get('type') == 'replace_block' else 1)
+        ops_to_apply_this_retry = retry_block_ops + retry_line_ops
 
         if not ops_to_apply_this_retry:
             print(f"{Fore.YELLOW}No valid replacement tags found in AI's retry response for the failed files.{Style.RESET_ALL}")
         else:
             print(f"{Fore.CYAN}Applying corrections from retry attempt {retry_attempt}...{Style.RESET_ALL}")
-            retry_apply_result = apply_changes(ops_to_apply_this_retry) # Apply the parsed ops
+            retry_apply_result = apply_changes(ops_to_apply_this_retry, file_cache) # Apply the parsed ops
 
             # Update history
             # ... (update history logic - unchanged) ...
@@ -1300,17 +1777,16 @@ def retry_failed_replacements(failed_ops, client_or_model, provider, model_name,
 
             # Update remaining_failed - keep track of operation types separately
             current_remaining = []
+            successful_keys = {(op['filename'], op['type']) for op in retry_apply_result.get('successful', [])}
             
             # Check which operations are still failing
             for op in remaining_failed:
                 # Check if this operation was successfully applied in this retry
                 if op['type'] == 'replace_lines':
-                    if not any(success_op['filename'] == op['filename'] and success_op['type'] == 'replace_lines' 
-                              for success_op in retry_apply_result.get('successful', [])):
+                    if (op['filename'], 'replace_lines') not in successful_keys:
                         current_remaining.append(op)
                 elif op['type'] == 'replace_block':
-                    if not any(success_op['filename'] == op['filename'] and success_op['type'] == 'replace_block' 
-                              for success_op in retry_apply_result.get('successful', [])):
+                    if (op['filename'], 'replace_block') not in successful_keys:
                         # Check max retries for block operations
                         if op['type'] == 'replace_block' and retry_attempt >= max_block_retries:
                             final_failed.append(op)
@@ -1321,11 +1797,14 @@ def retry_failed_replacements(failed_ops, client_or_model, provider, model_name,
 
         # Stop line-based retries early if we've reached the standard max_retries
         if retry_attempt >= max_retries:
-            # Move all line-based operations to final_failed
-            line_ops_to_move = [op for op in remaining_failed if op['type'] == 'replace_lines']
-            final_failed.extend(line_ops_to_move)
-            # Keep only block-based operations for further retries
-            remaining_failed = [op for op in remaining_failed if op['type'] == 'replace_block']
+            # Move all line-based operations to final_failed and keep only block-based ones for further retries (one pass)
+            block_ops_left = []
+            for op in remaining_failed:
+                if op['type'] == 'replace_lines':
+                    final_failed.append(op)
+                elif op['type'] == 'replace_block':
+                    block_ops_left.append(op)
+            remaining_failed = block_ops_left
 
         retry_attempt += 1
         if remaining_failed and retry_attempt <= max(max_retries, max_block_retries):
@@ -1333,6 +1812,9 @@ def retry_failed_replacements(failed_ops, client_or_model, provider, model_name,
 
     # ... (final logging and return) ...
     final_failed.extend(remaining_failed) # Add any ops that still failed after retries
+    for op in final_failed:
+        op.pop("_cached_file_lines", None) # Don't keep file contents alive past the retry horizon
+        op.pop("_cached_file_rs", None)
     print(f"{Fore.YELLOW}--- Auto-Retry Finished ---{Style.RESET_ALL}")
     if newly_successful:
          print(f"{Fore.GREEN}Successfully applied corrections for: {', '.join(list({op['filename'] for op in newly_successful}))}{Style.RESET_ALL}")
@@ -1340,16 +1822,38 @@ def retry_failed_replacements(failed_ops, client_or_model, provider, model_name,
          print(f"{Fore.RED}Still failed after retries: {', '.join(list({op['filename'] for op in final_failed}))}{Style.RESET_ALL}")
     return {"newly_successful": newly_successful, "final_failed": final_failed}
 
+# Upper bound on how much of a single file is injected into the prompt
+MAX_CONTEXT_FILE_CHARS = 64 * 1024
+
+@functools.lru_cache(maxsize=256)
+def _read_capped(filename, mtime):
+    """Reads at most MAX_CONTEXT_FILE_CHARS of a text file, or None if it looks binary; `mtime` is part of the cache key so edits invalidate it."""
+    with Path(filename).open('rb') as f:
+        raw = f.read(MAX_CONTEXT_FILE_CHARS * 4 + 1) # Enough bytes for the char cap even if every char is 4 bytes of UTF-8
+    if b'\x00' in raw[:4096]: # NUL in the first block: binary, skip decoding entirely
+        return None
+    content = raw.decode('utf-8', errors='replace')
+    if '\r' in content: # Match the universal-newline handling text mode used to give us
+        content = content.replace('\r\n', '\n').replace('\r', '\n')
+    if len(content) > MAX_CONTEXT_FILE_CHARS:
+        content = content[:MAX_CONTEXT_FILE_CHARS] + f"\n[... truncated after {MAX_CONTEXT_FILE_CHARS} characters ...]"
+    return content
+
+# Regex to find @ followed by path chars or 'codebase'
+_MENTION_RE = re.compile(r"(@[\w/.\-]+)")
+# Runs of whitespace, collapsed to one space once mentions are removed
+_WS_RE = re.compile(r"\s+")
+
 def process_mentions(user_input):
     """
     Find @path/to/file mentions and @codebase in user input, read files/get structure,
     and prepend their content (with line numbers) to the input string for the model.
     Returns the processed input and the original input with mentions removed.
     """
-    mention_pattern = r"(@[\w\/\.\-\_]+)" # Regex to find @ followed by path chars or 'codebase'
-    mentions = re.findall(mention_pattern, user_input)
+    # Single regex pass; the match objects are reused for both the emptiness check and the loop
+    mentions = list(_MENTION_RE.finditer(user_input))
 
-    prepended_content = ""
+    prepended_parts = [] # Joined once at the end instead of repeated += on a growing string
     mentioned_files = set() # Keep track to avoid duplicates
     processed_mention_spans = [] # Store (start, end) of processed mentions
 
@@ -1358,8 +1862,8 @@ def process_mentions(user_input):
 
     print(f"{Style.DIM}--- Processing Mentions ---{Style.RESET_ALL}")
 
-    # Use finditer to get match objects with positions
-    for match in re.finditer(mention_pattern, user_input):
+    # Match objects carry the positions needed to strip the mentions afterwards
+    for match in mentions:
         mention_text = match.group(1) # The full mention, e.g., "@path/to/file"
         raw_target = mention_text[1:] # Remove the leading '@'
 
@@ -1374,9 +1878,9 @@ def process_mentions(user_input):
                 # --- END ADDED ---
 
                 # Prepare content for the AI prompt (ONLY the structure)
-                prepended_content += f"\n{Style.BRIGHT}{Fore.MAGENTA}--- CODEBASE STRUCTURE ---{Style.RESET_ALL}\n"
-                prepended_content += f"```\n{codebase_structure}\n```\n" # Inject the structure
-                prepended_content += f"{Style.BRIGHT}{Fore.MAGENTA}--- END CODEBASE STRUCTURE ---{Style.RESET_ALL}\n\n"
+                prepended_parts.append(f"\n{Style.BRIGHT}{Fore.MAGENTA}--- CODEBASE STRUCTURE ---{Style.RESET_ALL}\n")
+                prepended_parts.append(f"```\n{codebase_structure}\n```\n") # Inject the structure
+                prepended_parts.append(f"{Style.BRIGHT}{Fore.MAGENTA}--- END CODEBASE STRUCTURE ---{Style.RESET_ALL}\n\n")
                 
                 mentioned_files.add("codebase")
                 processed_mention_spans.append(match.span())
@@ -1392,53 +1896,59 @@ def process_mentions(user_input):
 
         full_path = os.path.abspath(filepath) # Get absolute path
 
-        if os.path.exists(full_path) and os.path.isfile(full_path):
+        # One stat answers exists/isfile and gives the mtime for the read cache
+        try:
+            st = os.stat(full_path)
+        except OSError:
+            st = None
+
+        if st is not None and stat.S_ISREG(st.st_mode):
             try:
-                with open(full_path, 'r', encoding='utf-8') as f:
-                    file_content = f.read()
+                # Memoized by mtime, so re-mentioning an unchanged file doesn't hit the disk again
+                file_content = _read_capped(full_path, st.st_mtime)
+                if file_content is None:
+                    print(f"{Fore.YELLOW}  Warning: Cannot read mentioned binary file: {filepath}{Style.RESET_ALL}")
+                    prepended_parts.append(f"\n{Fore.YELLOW}[CodAgent Note: Mentioned file '{filepath}' is likely binary and could not be read.]{Style.RESET_ALL}\n\n")
+                    mentioned_files.add(filepath)
+                    processed_mention_spans.append(match.span())
+                    continue
 
                 print(f"{Fore.CYAN}  Injecting content from: {filepath}{Style.RESET_ALL}") # Removed mention of line numbers
 
-                # Format with line numbers (Now just returns content)
-                # numbered_content = _format_content_with_lines(file_content)
-
-                prepended_content += f"\n{Style.BRIGHT}{Fore.MAGENTA}--- MENTIONED FILE: {filepath} ---{Style.RESET_ALL}\n" # Removed (Line Numbered)
-                prepended_content += f"```\n{file_content}\n```\n" # Use raw file_content
-                prepended_content += f"{Style.BRIGHT}{Fore.MAGENTA}--- END MENTIONED FILE: {filepath} ---{Style.RESET_ALL}\n\n"
+                prepended_parts.append(f"\n{Style.BRIGHT}{Fore.MAGENTA}--- MENTIONED FILE: {filepath} ---{Style.RESET_ALL}\n") # Removed (Line Numbered)
+                prepended_parts.append(f"```\n{file_content}\n```\n") # Use raw file_content
+                prepended_parts.append(f"{Style.BRIGHT}{Fore.MAGENTA}--- END MENTIONED FILE: {filepath} ---{Style.RESET_ALL}\n\n")
 
                 mentioned_files.add(filepath)
                 processed_mention_spans.append(match.span())
 
-            except UnicodeDecodeError:
-                print(f"{Fore.YELLOW}  Warning: Cannot read mentioned binary file: {filepath}{Style.RESET_ALL}")
-                prepended_content += f"\n{Fore.YELLOW}[CodAgent Note: Mentioned file '{filepath}' is likely binary and could not be read.]{Style.RESET_ALL}\n\n"
-                mentioned_files.add(filepath)
-                processed_mention_spans.append(match.span())
             except Exception as e:
                 print(f"{Fore.RED}  Error reading mentioned file {filepath}: {e}{Style.RESET_ALL}")
-                prepended_content += f"\n{Fore.RED}[CodAgent Note: Error reading mentioned file '{filepath}'.]{Style.RESET_ALL}\n\n"
+                prepended_parts.append(f"\n{Fore.RED}[CodAgent Note: Error reading mentioned file '{filepath}'.]{Style.RESET_ALL}\n\n")
                 mentioned_files.add(filepath)
                 processed_mention_spans.append(match.span())
         else:
             print(f"{Fore.YELLOW}  Warning: Mentioned file not found or is not a file: {filepath}{Style.RESET_ALL}")
             # Optionally inform the model the file wasn't found
-            prepended_content += f"\n{Fore.YELLOW}[CodAgent Note: Mentioned file '{filepath}' not found.]{Style.RESET_ALL}\n\n"
+            prepended_parts.append(f"\n{Fore.YELLOW}[CodAgent Note: Mentioned file '{filepath}' not found.]{Style.RESET_ALL}\n\n")
             mentioned_files.add(filepath) # Add even if not found to avoid reprocessing
 
     # --- Clean the original input by removing processed mentions ---
-    cleaned_user_input = ""
+    cleaned_parts = []
     last_end = 0
     # Sort spans to process them in order
     processed_mention_spans.sort(key=lambda x: x[0])
     for start, end in processed_mention_spans:
-        cleaned_user_input += user_input[last_end:start]
+        cleaned_parts.append(user_input[last_end:start])
         last_end = end
-    cleaned_user_input += user_input[last_end:]
+    cleaned_parts.append(user_input[last_end:])
+    cleaned_user_input = "".join(cleaned_parts)
     # Remove potential leftover whitespace after cleaning
-    cleaned_user_input = ' '.join(cleaned_user_input.split())
+    cleaned_user_input = _WS_RE.sub(" ", cleaned_user_input).strip()
 
 
-    if prepended_content:
+    if prepended_parts:
+         prepended_content = "".join(prepended_parts)
          print(f"{Style.DIM}--- End Processing Mentions ---{Style.RESET_ALL}")
          return prepended_content + cleaned_user_input, cleaned_user_input
     else:
@@ -1484,7 +1994,47 @@ class MentionCompleter(Completer):
         # else: # No need for explicit else pass
 
 
-def chat_with_model(client_or_model, provider, model_name): # Modified signature
+# Number of recent conversation entries sent to the model and shown each turn
+HISTORY_WINDOW = 10
+
+# Invariant status/instruction text for the per-segment summaries; only the % fields vary
+_STATUS_INTERRUPTED = f"{Fore.YELLOW}⚠ INTERRUPTED (Code: %s){Style.RESET_ALL}"
+_STATUS_OK = f"{Fore.GREEN}✓ SUCCESS (Code: 0){Style.RESET_ALL}"
+_STATUS_FAILED = f"{Fore.RED}✗ FAILED (Code: %s){Style.RESET_ALL}"
+_REVIEW_INSTRUCTION = "**SYSTEM CHECK:** Files %s were modified. Please carefully review their full content in the `--- FILE CONTEXT ---` above for correctness (syntax and logic) based on the original request before proceeding. If you find errors, provide fixes. If not, continue or use `[END]` if the task is complete."
+
+@functools.lru_cache(maxsize=4096)
+def _norm(path):
+    """os.path.normpath, memoized; the same handful of filenames are normalised over and over."""
+    return os.path.normpath(path)
+
+# normpath -> (mtime_ns, size) of files whose last syntax check passed; a match skips the check entirely
+_SYNTAX_OK_FILES = {}
+
+@functools.lru_cache(maxsize=256)
+def _syntax_check(path, mtime_ns, size):
+    """Compiles `path` in-process; returns the formatted error, or None if it compiles. mtime and size are part of the cache key so edits invalidate it."""
+    with open(path, 'rb') as f:
+        source = f.read()
+    try:
+        compile(source, path, 'exec', dont_inherit=True)
+    except (SyntaxError, ValueError) as e: # ValueError: source contains null bytes
+        return "".join(traceback.format_exception_only(type(e), e)).strip()
+    return None
+
+def _provider_history(history, provider):
+    """Converts conversation entries to the provider's message format in one pass; system notes are not sent."""
+    if provider == "google":
+        return [{"role": entry['role'], "parts": [entry['content']]} for entry in history if entry['role'] in ('user', 'model')]
+    # OpenAI-style API: map 'model' to 'assistant'
+    return [{"role": "assistant" if entry['role'] == 'model' else "user", "content": entry['content']}
+            for entry in history if entry['role'] in ('user', 'model')]
+
+class AutoFixRequired(Exception):
+    """Custom exception to signal that the auto-fix loop needs to continue."""
+    pass
+
+def chat_with_model(client_or_model, provider, model_name, auto_confirm=False): # Modified signature
     """Start an interactive chat with the model."""
     # History file in the current directory
     history_file = os.path.join(os.getcwd(), ".chat.history.codagent")
@@ -1493,30 +2043,37 @@ def chat_with_model(client_or_model, provider, model_name): # Modified signature
     added_context = {}
     
     # Track all files created or modified during this session
+    # Dicts with None values act as insertion-ordered sets: O(1) add/remove/contains
     file_history = {
-        "created": [],
-        "modified": [],
-        "current_workspace": []
+        "created": {},
+        "modified": {},
+        "current_workspace": {}
     }
     
     # Initialize the file history with existing files in the workspace
-    for file in glob.glob("**/*", recursive=True):
-        if os.path.isfile(file) and not file.startswith('.') and not file.startswith('__pycache__'):
-            file_history["current_workspace"].append(file)
+    file_history["current_workspace"].update(dict.fromkeys(scan_workspace_files()))
+    # Bumped whenever file_history changes so the rendered file context is only rebuilt when stale
+    file_history_version = 0
+    file_context_cache = (None, "") # (version, rendered context)
     
     # --- Load Initial and Reminder System Prompts --- Start
+    # Built once per session; the loop below only picks between the two strings
     initial_system_prompt = get_system_prompt(is_reminder=False)
     reminder_system_prompt = get_system_prompt(is_reminder=True)
     # --- Load Initial and Reminder System Prompts --- End
 
     # Check if we have previous chat history to load
     previous_conversation = []
-    if os.path.exists(history_file) and os.path.getsize(history_file) > 0:
+    try:
+        history_size = os.stat(history_file).st_size # One stat for both the existence and size checks
+    except OSError:
+        history_size = 0
+    if history_size > 0:
         print(f"{Fore.GREEN}Found existing chat history in this directory.{Style.RESET_ALL}")
         try:
             with open(history_file, 'r', encoding='utf-8') as f:
-                # Read the last 20 lines from history to get recent context
-                lines = f.readlines()
+                # Read the last 20 lines from history to get recent context; the deque keeps only those in memory
+                lines = list(collections.deque(f, maxlen=20))
                 if lines:
                     # Extract the last few user inputs from history
                     user_inputs = [line.strip() for line in lines if line.strip() and not line.startswith('#')]
@@ -1547,7 +2104,8 @@ def chat_with_model(client_or_model, provider, model_name): # Modified signature
     print("-" * 40) # Separator
     
     # Keep track of conversation to maintain context
-    conversation_history = [] # Reset history for each run for simplicity now
+    # Only the last HISTORY_WINDOW entries are ever read, so older ones are dropped on append
+    conversation_history = collections.deque(maxlen=HISTORY_WINDOW) # Reset history for each run for simplicity now
     # If you want persistent history across runs, load it here based on provider/model?
     
     # --- Initialize the custom completer ---
@@ -1560,13 +2118,12 @@ def chat_with_model(client_or_model, provider, model_name): # Modified signature
     # Store context that needs to be prepended *outside* the AI's direct turn
     pending_context_injection = ""
 
-    # --- Add Custom Exception Class --- Start
-    class AutoFixRequired(Exception):
-        """Custom exception to signal that the auto-fix loop needs to continue."""
-        pass
-    # --- Add Custom Exception Class --- End
 
     turn_count = 0 # Keep track of turns for system prompt logic
+    last_syntax_sig = None # Syntax errors that triggered the last auto-fix, to detect a stuck fix loop
+
+    # CodAgent never changes directory (commands run in subprocesses), so the prompt label is fixed
+    rprompt_text = f"[{Fore.CYAN}{os.path.basename(os.getcwd())}{Style.RESET_ALL}]"
 
     while True:
         main_loop_interrupted = False # Flag to indicate if main loop caught interrupt
@@ -1576,21 +2133,24 @@ def chat_with_model(client_or_model, provider, model_name): # Modified signature
             pending_context_injection = "" # Clear after use
 
             # Add separator
-            print(f"\n{Fore.BLUE}{H * (min(os.get_terminal_size().columns, 80))}{Style.RESET_ALL}")
+            print(f"\n{Fore.BLUE}{H * min(_term_width(), 80)}{Style.RESET_ALL}") # Cached width, refreshed on SIGWINCH
 
             # --- Get User Input ---
             # (Only prompt user if there isn't context waiting from auto-fix/file selection)
             if not current_context_for_model:
                 # ... (Existing user input prompt logic remains here) ...
-                rprompt_text = f"[{Fore.CYAN}{os.path.basename(os.getcwd())}{Style.RESET_ALL}]"
-                raw_user_input = prompt(
-                    "CodAgent >>> ",
-                    history=FileHistory(history_file),
-                    auto_suggest=AutoSuggestFromHistory(),
-                    completer=mention_completer,
-                    style=style,
-                    rprompt=ANSI(rprompt_text)
-                )
+                try:
+                    raw_user_input = prompt(
+                        "CodAgent >>> ",
+                        history=FileHistory(history_file),
+                        auto_suggest=AutoSuggestFromHistory(),
+                        completer=mention_completer,
+                        style=style,
+                        rprompt=ANSI(rprompt_text)
+                    )
+                finally:
+                    _refresh_term_width() # The prompt left SIGWINCH at SIG_DFL and may have missed resizes
+
                 if raw_user_input.lower().strip() in ['exit', 'quit', 'q']:
                     print(f"{Fore.YELLOW}Exiting CodAgent session.{Style.RESET_ALL}")
                     break
@@ -1601,6 +2161,7 @@ def chat_with_model(client_or_model, provider, model_name): # Modified signature
                 # Add user input (after mentions processed) to the context for this turn
                 current_context_for_model += user_input_for_model
                 turn_count += 1 # Increment turn count on new user input
+                last_syntax_sig = None # Stuck-loop detection only spans one auto-fix chain
 
             # --- Determine Which System Prompt to Use --- Start
             # Use initial prompt on first turn, reminder prompt otherwise
@@ -1608,41 +2169,30 @@ def chat_with_model(client_or_model, provider, model_name): # Modified signature
             # --- Determine Which System Prompt to Use --- End
 
             # --- Prepare Prompt for AI ---
-            # system_prompt = get_system_prompt() # Replaced by active_system_prompt
-            file_context_for_prompt = generate_file_context(file_history)
+            if file_context_cache[0] != file_history_version:
+                file_context_cache = (file_history_version, generate_file_context(file_history))
+            file_context_for_prompt = file_context_cache[1]
 
             # --- Format History for Model ---
             # ... (Existing history formatting logic for Google/OpenRouter) ...
             history_for_model = []
+            # The bounded deque already is the recent window; it feeds both the model history and the console display
+            recent_history = conversation_history
             if provider == "google":
-                 combined_history = []
-                 temp_history = conversation_history[-10:] # Limit history context
-                 for entry in temp_history:
-                      role = entry['role']
-                      if role in ['user', 'model']:
-                          # Combine role and content
-                          combined_history.append({"role": role, "parts": [entry['content']]})
-                 history_for_model = combined_history 
+                 history_for_model = _provider_history(recent_history, provider)
             elif provider == "openrouter":
                  # Always start with the active system prompt for OpenRouter
-                 openai_messages = [{"role": "system", "content": active_system_prompt}]
-                 temp_history = conversation_history[-10:] # Limit history context
-                 for entry in temp_history:
-                      role = entry['role']
-                      if role == 'user':
-                          openai_messages.append({"role": "user", "content": entry['content']})
-                      elif role == 'model':
-                           # Map 'model' role from history to 'assistant' for OpenAI API
-                           openai_messages.append({"role": "assistant", "content": entry['content']})
-                 history_for_model = openai_messages 
+                 history_for_model = [{"role": "system", "content": active_system_prompt}]
+                 history_for_model.extend(_provider_history(recent_history, provider)) 
+
+            # Console output up to the stream is collected here and written in one go
+            turn_out = []
 
             # Display history in the console (unified format)
-            history_to_display = min(10, len(conversation_history))
+            history_to_display = len(recent_history)
             # ... (Existing history display formatting) ...
             prompt_history_formatted = []
-            start_index = len(conversation_history) - history_to_display
-            for i in range(start_index, len(conversation_history)):
-                 entry = conversation_history[i]
+            for entry in recent_history:
                  role = entry['role']
                  prefix = f"{role.upper()}: "
                  if role == 'system': prefix = f"{Fore.YELLOW}SYSTEM NOTE:{Style.RESET_ALL} "
@@ -1650,8 +2200,9 @@ def chat_with_model(client_or_model, provider, model_name): # Modified signature
                  elif role == 'model': prefix = f"{Fore.CYAN}MODEL:{Style.RESET_ALL} "
                  prompt_history_formatted.append(prefix + entry['content'])
             if prompt_history_formatted:
-                 print(f"{Style.BRIGHT}{Fore.MAGENTA}--- CONVERSATION HISTORY (Last {history_to_display}) ---{Style.RESET_ALL}\n" + "\n\n".join(prompt_history_formatted))
-                 print(f"\n{Style.BRIGHT}{Fore.MAGENTA}--- END HISTORY ---{Style.RESET_ALL}")
+                 turn_out.append(f"{Style.BRIGHT}{Fore.MAGENTA}--- CONVERSATION HISTORY (Last {history_to_display}) ---{Style.RESET_ALL}\n")
+                 turn_out.append("\n\n".join(prompt_history_formatted))
+                 turn_out.append(f"\n\n{Style.BRIGHT}{Fore.MAGENTA}--- END HISTORY ---{Style.RESET_ALL}\n")
 
             # --- Construct Final Prompt/Messages ---
             # ... (Existing provider-specific prompt/message construction) ...
@@ -1662,7 +2213,8 @@ def chat_with_model(client_or_model, provider, model_name): # Modified signature
                  prompt_string_for_google = "\n\n".join([active_system_prompt, file_context_for_prompt, current_context_for_model if current_context_for_model else "Continue."])
 
                  # Construct content for generate_content API call
-                 generation_request_content = history_for_model + [{"role": "user", "parts": [prompt_string_for_google]}] # Include system/file context here
+                 generation_request_content = history_for_model # Built fresh above, so append in place
+                 generation_request_content.append({"role": "user", "parts": [prompt_string_for_google]}) # Include system/file context here
             elif provider == "openrouter":
                  # System prompt is already the first message in history_for_model
                  # Append the file context and current user input/context as the latest user message
@@ -1678,7 +2230,9 @@ def chat_with_model(client_or_model, provider, model_name): # Modified signature
             user_question = None
             files_to_ask_user_for = []
 
-            print(f"\n{Style.DIM}--- CodAgent Thinking ---{Style.RESET_ALL}")
+            turn_out.append(f"\n{Style.DIM}--- CodAgent Thinking ---{Style.RESET_ALL}\n")
+            sys.stdout.write("".join(turn_out))
+            sys.stdout.flush()
 
             # --- Inner loop needs adjustment for system prompt injection ---
             # The prompt is constructed *before* this loop now.
@@ -1687,6 +2241,7 @@ def chat_with_model(client_or_model, provider, model_name): # Modified signature
             while not is_end_of_turn and not ask_for_files_detected and not ask_to_user_detected: # Added ask_to_user check
                 print(f"\n{Style.BRIGHT}{Fore.GREEN}>>> AI Response Segment {len(all_responses_this_turn) + 1} >>>{Style.RESET_ALL}")
                 current_segment_text = ""
+                segment_chunks = [] # Streamed pieces, joined once the stream ends
                 stream_error_occurred = False
                 segment_apply_result = None # Reset apply result for this segment
                 executed_command_results = [] # Reset command results for this segment
@@ -1701,17 +2256,9 @@ def chat_with_model(client_or_model, provider, model_name): # Modified signature
                         for chunk in response_stream:
                              try:
                                  chunk_text = chunk.text
-                                 # ... (Logic to hide [END] tag during print) ...
-                                 text_to_print = chunk_text
-                                 temp_full_segment = current_segment_text + chunk_text
-                                 if temp_full_segment.rstrip().endswith("[END]"):
-                                     tag_start_index = temp_full_segment.rstrip().rfind("[END]")
-                                     prev_segment_len = len(current_segment_text)
-                                     if tag_start_index >= prev_segment_len:
-                                         tag_start_in_chunk = tag_start_index - prev_segment_len
-                                         text_to_print = chunk_text[:tag_start_in_chunk]
+                                 text_to_print = _strip_end_tag_from_chunk(chunk_text) # Hide [END] tag during print
                                  print(text_to_print, end='', flush=True) 
-                                 current_segment_text += chunk_text 
+                                 segment_chunks.append(chunk_text)
                              except ValueError: pass
                              except Exception as e_text_access: print(f"\n{Fore.RED}Error processing Google stream chunk text: {e_text_access}{Style.RESET_ALL}", flush=True)
                     elif provider == "openrouter":
@@ -1722,18 +2269,11 @@ def chat_with_model(client_or_model, provider, model_name): # Modified signature
                          for chunk in response_stream:
                               if chunk.choices and chunk.choices[0].delta and chunk.choices[0].delta.content:
                                    chunk_text = chunk.choices[0].delta.content
-                                   # ... (Logic to hide [END] tag during print) ...
-                                   text_to_print = chunk_text
-                                   temp_full_segment = current_segment_text + chunk_text
-                                   if temp_full_segment.rstrip().endswith("[END]"):
-                                       tag_start_index = temp_full_segment.rstrip().rfind("[END]")
-                                       prev_segment_len = len(current_segment_text)
-                                       if tag_start_index >= prev_segment_len:
-                                           tag_start_in_chunk = tag_start_index - prev_segment_len
-                                           text_to_print = chunk_text[:tag_start_in_chunk]
+                                   text_to_print = _strip_end_tag_from_chunk(chunk_text) # Hide [END] tag during print
                                    print(text_to_print, end='', flush=True) 
-                                   current_segment_text += chunk_text 
+                                   segment_chunks.append(chunk_text)
                     # --- Call Correct API --- End
+                    current_segment_text = "".join(segment_chunks)
                     print() # Newline after segment stream
                 except Exception as model_error:
                      print(f"\n{Back.RED}{Fore.WHITE} ERROR during model generation request: {model_error} {Style.RESET_ALL}")
@@ -1745,8 +2285,11 @@ def chat_with_model(client_or_model, provider, model_name): # Modified signature
                 segment_for_processing = current_segment_text
                 segment_to_log = current_segment_text # Store original segment for logging
 
+                # Find which tags are present, then only run the matching parsers
+                tags_found = set() if stream_error_occurred else {m.lastgroup for m in _TAG_RE.finditer(segment_for_processing)}
+
                 # 1. Check for ====== ASK_FOR_FILES first
-                if not stream_error_occurred:
+                if "ask_files" in tags_found:
                     extracted_files, segment_without_ask_tag = parse_ask_for_files(segment_for_processing)
                     if extracted_files:
                         print(f"\n{Fore.YELLOW}[CodAgent needs files... Processing request.]){Style.RESET_ALL}")
@@ -1760,7 +2303,7 @@ def chat_with_model(client_or_model, provider, model_name): # Modified signature
                         break # Break inner loop immediately to handle ASK prompt
 
                 # 1.5 Check for ====== ASK_TO_USER
-                if not stream_error_occurred and not ask_for_files_detected:
+                if "ask_user" in tags_found and not ask_for_files_detected:
                     extracted_question, segment_without_ask_tag = parse_ask_to_user(segment_for_processing)
                     if extracted_question:
                         print(f"\n{Fore.YELLOW}[CodAgent is asking you a question... ({extracted_question['format']} format)]{Style.RESET_ALL}")
@@ -1774,7 +2317,7 @@ def chat_with_model(client_or_model, provider, model_name): # Modified signature
                         break # Break inner loop immediately to handle question
 
                 # 2. Check for [END] tag (Final end-of-turn signal)
-                if not stream_error_occurred and not ask_for_files_detected and not ask_to_user_detected:
+                if "end" in tags_found and not ask_for_files_detected and not ask_to_user_detected:
                      parsed_segment, is_end_from_tag = parse_end_response(segment_for_processing)
                      if is_end_from_tag:
                           segment_for_processing = parsed_segment # Use text without tag for actions
@@ -1791,33 +2334,41 @@ def chat_with_model(client_or_model, provider, model_name): # Modified signature
 
                 # --- Execute File Operations for this Segment ---
                 if not stream_error_occurred and not ask_for_files_detected and not ask_to_user_detected: # Added ask_to_user check
-                    segment_file_ops = parse_file_operations(segment_for_processing)
+                    segment_file_ops = parse_file_operations(segment_for_processing) if "file_op" in tags_found else []
                     if segment_file_ops:
                         print("\n" + "="*5 + f" File Operations Proposed (Segment {len(all_responses_this_turn)}) " + "="*5)
-                        if preview_changes(segment_file_ops):
-                            segment_apply_result = apply_changes(segment_file_ops)
+                        if preview_changes(segment_file_ops, auto_confirm=auto_confirm):
+                            file_cache = {} # File contents shared by this apply and its retries; cleared once they are done
+                            segment_apply_result = apply_changes(segment_file_ops, file_cache)
+                            # --- Initialize list of successful operations for this segment ---
+                            # Used in place; it is extended if retries are successful.
+                            successful_ops_this_segment = segment_apply_result.get("successful", [])
+                            # One pass over the successful ops collects unique filenames and updates the internal file state tracker
+                            succ_files = {} # Ordered unique filenames
+                            python_files_changed = {} # The .py subset, for the syntax check
+                            for op in successful_ops_this_segment:
+                                succ_files[op['filename']] = None
+                                if op['filename'].endswith('.py'): python_files_changed[op['filename']] = None
+                                norm_filename = _norm(op["filename"])
+                                if op["type"] == "create":
+                                    file_history["created"][norm_filename] = None
+                                    file_history["current_workspace"][norm_filename] = None
+                                    file_history["modified"].pop(norm_filename, None)
+                                elif op["type"] in ["rewrite", "replace_block"]: # Added rewrite and replace_block
+                                    if norm_filename not in file_history["created"]: file_history["modified"][norm_filename] = None
+                                    file_history["current_workspace"][norm_filename] = None
+                            if succ_files:
+                                file_history_version += 1
+                            fail_files = list(dict.fromkeys(op['filename'] for op in segment_apply_result.get('failed', ())))
+                            modified_filenames = succ_files # Unique filenames of successful_ops_this_segment; retries add to it after the summary is built
+
                             # Update system history with results
                             op_summary_lines_segment = [f"File Operations Status (Segment {len(all_responses_this_turn)})]:"]
-                            if segment_apply_result.get('successful'): op_summary_lines_segment.append(f"  {Fore.GREEN}Successful ({len(segment_apply_result['successful'])}):{Style.RESET_ALL} {', '.join(list({op['filename'] for op in segment_apply_result['successful']}))}")
-                            if segment_apply_result.get('failed'): op_summary_lines_segment.append(f"  {Fore.RED}Failed ({len(segment_apply_result['failed'])}):{Style.RESET_ALL} {', '.join(list({op['filename'] for op in segment_apply_result['failed']}))}")
+                            if succ_files: op_summary_lines_segment.append(f"  {Fore.GREEN}Successful ({len(successful_ops_this_segment)}):{Style.RESET_ALL} {', '.join(succ_files)}")
+                            if fail_files: op_summary_lines_segment.append(f"  {Fore.RED}Failed ({len(segment_apply_result['failed'])}):{Style.RESET_ALL} {', '.join(fail_files)}")
                             # Don't add to conversation_history if it's empty
                             if len(op_summary_lines_segment) > 1:
                                 conversation_history.append({"role": "system", "content": "\n".join(op_summary_lines_segment)})
-                            # Update internal file state tracker
-                            for op in segment_apply_result.get("successful", []):
-                                norm_filename = os.path.normpath(op["filename"])
-                                # ... (file_history update logic remains same) ...
-                                if op["type"] == "create":
-                                    if norm_filename not in file_history["created"]: file_history["created"].append(norm_filename)
-                                    if norm_filename not in file_history["current_workspace"]: file_history["current_workspace"].append(norm_filename)
-                                    if norm_filename in file_history["modified"]: file_history["modified"].remove(norm_filename)
-                                elif op["type"] in ["rewrite", "replace_block"]: # Added rewrite and replace_block
-                                    if norm_filename not in file_history["modified"] and norm_filename not in file_history["created"]: file_history["modified"].append(norm_filename)
-                                    if norm_filename not in file_history["current_workspace"]: file_history["current_workspace"].append(norm_filename)
-
-                            # --- Initialize list of successful operations for this segment ---
-                            # Make a copy initially. This list will be extended if retries are successful.
-                            successful_ops_this_segment = segment_apply_result.get("successful", [])[:]
 
                             # --- Check for and Trigger BLOCK REPLACE Retries ---
                             failed_block_ops = [op for op in segment_apply_result.get("failed", []) if op.get('type') == 'replace_block']
@@ -1829,49 +2380,79 @@ def chat_with_model(client_or_model, provider, model_name): # Modified signature
                                     provider,
                                     model_name,
                                     file_history,
-                                    conversation_history # Pass current history
+                                    conversation_history, # Pass current history
+                                    file_cache=file_cache
                                 )
                                 # Update successful ops list and file history with newly successful retries
                                 if retry_result.get('newly_successful'):
                                     # Update file history for newly successful ops first
                                     for op in retry_result['newly_successful']:
-                                        norm_filename = os.path.normpath(op["filename"])
-                                        if norm_filename not in file_history["modified"] and norm_filename not in file_history["created"]:
-                                             file_history["modified"].append(norm_filename)
-                                        if norm_filename not in file_history["current_workspace"]:
-                                             file_history["current_workspace"].append(norm_filename)
+                                        modified_filenames[op['filename']] = None
+                                        if op['filename'].endswith('.py'): python_files_changed[op['filename']] = None
+                                        norm_filename = _norm(op["filename"])
+                                        if norm_filename not in file_history["created"]:
+                                             file_history["modified"][norm_filename] = None
+                                        file_history["current_workspace"][norm_filename] = None
+                                    file_history_version += 1
                                     # NOW extend the list used for subsequent steps
                                     successful_ops_this_segment.extend(retry_result['newly_successful'])
                                 # Note: retry_failed_replacements logs its own results to history
+                            file_cache.clear() # The apply/retry cycle is over; later reads go to disk
 
                             # --- Add Explicit Review Instruction (Uses the potentially updated successful_ops_this_segment list) ---
                             if successful_ops_this_segment:
-                                modified_filenames = list({op['filename'] for op in successful_ops_this_segment})
-                                review_instruction = f"**SYSTEM CHECK:** Files {', '.join([f'`{f}`' for f in modified_filenames])} were modified. Please carefully review their full content in the `--- FILE CONTEXT ---` above for correctness (syntax and logic) based on the original request before proceeding. If you find errors, provide fixes. If not, continue or use `[END]` if the task is complete."
+                                review_instruction = _REVIEW_INSTRUCTION % ", ".join([f"`{f}`" for f in modified_filenames])
                                 conversation_history.append({"role": "system", "content": review_instruction})
 
                             # --- Run Syntax Check / Auto-Fix (Uses the potentially updated successful_ops_this_segment list) ---
                             if successful_ops_this_segment:
                                 # ... (Existing syntax check logic) ...
-                                python_files_changed = [op['filename'] for op in successful_ops_this_segment if op['filename'].endswith('.py')]
                                 syntax_errors_found = {}
                                 if python_files_changed:
                                     print(f"\n{Fore.CYAN}--- Running Syntax Checks on: {', '.join(python_files_changed)} ---{Style.RESET_ALL}")
+                                    # One stat per file both confirms it exists and gives its (mtime_ns, size) signature
+                                    files_to_check = []
+                                    check_sigs = {}
                                     for filename in python_files_changed:
-                                         if os.path.exists(filename):
-                                            try:
-                                                syntax_check_result = subprocess.run([sys.executable, "-m", "py_compile", filename], capture_output=True, text=True, check=False)
-                                                if syntax_check_result.returncode != 0 and syntax_check_result.stderr:
-                                                    error_output = syntax_check_result.stderr.strip()
-                                                    syntax_errors_found[filename] = error_output
-                                                    print(f"{Fore.RED}✗ Syntax Error detected in {filename}:{Style.RESET_ALL}\n{error_output}")
-                                                else: print(f"{Fore.GREEN}✓ Syntax OK for {filename}{Style.RESET_ALL}")
-                                            except Exception as e: print(f"{Fore.RED}Error running syntax check on {filename}: {e}{Style.RESET_ALL}")
-                                         else: print(f"{Fore.YELLOW}Skipping syntax check for {filename} (file not found after apply?){Style.RESET_ALL}")
+                                         try:
+                                             st = os.stat(filename)
+                                         except OSError:
+                                             print(f"{Fore.YELLOW}Skipping syntax check for {filename} (file not found after apply?){Style.RESET_ALL}")
+                                             continue
+                                         files_to_check.append(filename)
+                                         check_sigs[filename] = (st.st_mtime_ns, st.st_size)
+                                    # Files unchanged since they last passed are OK without being opened
+                                    stale_files = [f for f in files_to_check if _SYNTAX_OK_FILES.get(_norm(f)) != check_sigs[f]]
+                                    check_futures = {}
+                                    if stale_files:
+                                        # Compiled in-process with the running interpreter; reads overlap across a small pool
+                                        with ThreadPoolExecutor(max_workers=min(8, len(stale_files))) as executor:
+                                            check_futures = {f: executor.submit(_syntax_check, _norm(f), *check_sigs[f]) for f in stale_files}
+                                    for filename in files_to_check:
+                                        try:
+                                            error_output = check_futures[filename].result() if filename in check_futures else None
+                                            if error_output:
+                                                _SYNTAX_OK_FILES.pop(_norm(filename), None)
+                                                syntax_errors_found[filename] = error_output
+                                                print(f"{Fore.RED}✗ Syntax Error detected in {filename}:{Style.RESET_ALL}\n{error_output}")
+                                            else:
+                                                _SYNTAX_OK_FILES[_norm(filename)] = check_sigs[filename]
+                                                print(f"{Fore.GREEN}✓ Syntax OK for {filename}{Style.RESET_ALL}")
+                                        except Exception as e: print(f"{Fore.RED}Error running syntax check on {filename}: {e}{Style.RESET_ALL}")
+
+                                # Same files with the same errors as the last auto-fix request: the fix made no progress
+                                syntax_sig = frozenset(syntax_errors_found.items()) if syntax_errors_found else None
+                                if syntax_sig is not None and syntax_sig == last_syntax_sig:
+                                    print(f"\n{Fore.RED}--- Auto-Fix made no progress (same syntax errors); not retrying ---{Style.RESET_ALL}")
+                                    conversation_history.append({"role": "system", "content": f"Auto-fix made no progress on: {', '.join(syntax_errors_found)}; aborting fix loop."})
+                                    syntax_errors_found = {}
+                                last_syntax_sig = syntax_sig
 
                                 if syntax_errors_found:
                                     print(f"\n{Fore.YELLOW}--- Initiating Auto-Fix Check (Syntax Errors Detected) ---{Style.RESET_ALL}")
-                                    updated_file_context = generate_file_context(file_history)
+                                    if file_context_cache[0] != file_history_version:
+                                        file_context_cache = (file_history_version, generate_file_context(file_history))
+                                    updated_file_context = file_context_cache[1]
                                     error_details = "\n".join([f"File: `{fname}`\nError:\n```\n{err}\n```" for fname, err in syntax_errors_found.items()])
                                     affected_filenames = list(syntax_errors_found.keys())
                                     # Use the reminder prompt structure for auto-fix
@@ -1885,14 +2466,15 @@ def chat_with_model(client_or_model, provider, model_name): # Modified signature
 
                 # --- Execute Terminal Commands for this Segment ---
                 if not stream_error_occurred and not ask_for_files_detected and not ask_to_user_detected: # Added ask_to_user check
-                    segment_terminal_commands = parse_terminal_commands(segment_for_processing)
+                    segment_terminal_commands = parse_terminal_commands(segment_for_processing) if "terminal" in tags_found else []
                     if segment_terminal_commands:
                         # ... (Existing terminal command preview, confirmation, execution logic) ...
                         print("\n" + "="*5 + f" Terminal Commands Proposed (Segment {len(all_responses_this_turn)}) " + "="*5)
                         print_boxed(f"Terminal Commands Preview (Segment {len(all_responses_this_turn)})", "\n".join([f"- {cmd}" for cmd in segment_terminal_commands]), color=Fore.YELLOW)
                         print("-" * 30)
-                        confirm_terminal = input(f"{Style.BRIGHT}{Fore.CYAN}Execute these commands? (y/n): {Style.RESET_ALL}").lower().strip()
-                        if confirm_terminal.startswith('y'):
+                        if auto_confirm: print(f"{Fore.GREEN}Executing commands (--yes).{Style.RESET_ALL}")
+                        if auto_confirm or input(f"{Style.BRIGHT}{Fore.CYAN}Execute these commands? (y/n): {Style.RESET_ALL}").lower().strip().startswith('y'):
+                            seg_msgs = [] # History entries for this segment, added with one extend at the end
                             # Execute commands one by one
                             for command in segment_terminal_commands:
                                 # execute_terminal_command now handles live output and its own Ctrl+C
@@ -1902,7 +2484,7 @@ def chat_with_model(client_or_model, provider, model_name): # Modified signature
                                 if result.get("interrupted"):
                                     print(f"{Fore.YELLOW}Command '{command}' was interrupted. Stopping further commands in this segment.{Style.RESET_ALL}")
                                     # Add a note to history about the interruption stopping the sequence
-                                    conversation_history.append({"role": "system", "content": f"User interrupted command '{command}'. Subsequent commands in this segment were skipped."})
+                                    seg_msgs.append({"role": "system", "content": f"User interrupted command '{command}'. Subsequent commands in this segment were skipped."})
                                     break # Stop executing commands in this segment
 
                             # --- Update system history with results --- Start
@@ -1912,14 +2494,13 @@ def chat_with_model(client_or_model, provider, model_name): # Modified signature
                             for res in executed_command_results:
                                 cmd = res['command']
                                 cmd_result = res['result']
-                                status = ""
                                 # Format status based on return code and interrupted flag
                                 if cmd_result.get('interrupted'):
-                                     status = f"{Fore.YELLOW}⚠ INTERRUPTED (Code: {cmd_result['returncode']}){Style.RESET_ALL}"
+                                     status = _STATUS_INTERRUPTED % cmd_result['returncode']
                                 elif cmd_result['returncode'] == 0:
-                                     status = f"{Fore.GREEN}✓ SUCCESS (Code: 0){Style.RESET_ALL}"
+                                     status = _STATUS_OK
                                 else:
-                                     status = f"{Fore.RED}✗ FAILED (Code: {cmd_result['returncode']}){Style.RESET_ALL}"
+                                     status = _STATUS_FAILED % cmd_result['returncode']
 
                                 cmd_summary_lines_segment.append(f"`{cmd}`: {status}")
                                 # Only show output/error snippets if not interrupted (live output was already shown)
@@ -1933,14 +2514,15 @@ def chat_with_model(client_or_model, provider, model_name): # Modified signature
 
                             # Add summary to conversation history (for system tracking/user visibility)
                             if len(cmd_summary_lines_segment) > 1:
-                                conversation_history.append({"role": "system", "content": "\n".join(cmd_summary_lines_segment)})
+                                seg_msgs.append({"role": "system", "content": "\n".join(cmd_summary_lines_segment)})
 
                             # Add detailed logs back to the AI as user input (so it reacts to them)
                             if ai_logs_for_model:
                                 combined_ai_log = "\n\n".join([f"```\n{log}\n```" for log in ai_logs_for_model])
-                                conversation_history.append({"role": "user", "content": f"Terminal command output(s):\n{combined_ai_log}"})
+                                seg_msgs.append({"role": "user", "content": f"Terminal command output(s):\n{combined_ai_log}"})
                                 # Add acknowledgment to confirm receipt
-                                conversation_history.append({"role": "model", "content": "Received terminal output(s). Analyzing now."})
+                                seg_msgs.append({"role": "model", "content": "Received terminal output(s). Analyzing now."})
+                            conversation_history.extend(seg_msgs)
 
                             # --- Update system history with results --- End
 
@@ -1965,18 +2547,15 @@ def chat_with_model(client_or_model, provider, model_name): # Modified signature
                 # Update history structures before reconstructing the API call input
                 # The model's last response (segment_to_log) was already added to conversation_history
 
-                # Re-generate file context as it might have changed due to actions
-                file_context_for_prompt = generate_file_context(file_history)
+                # Re-generate file context if actions changed file_history
+                if file_context_cache[0] != file_history_version:
+                    file_context_cache = (file_history_version, generate_file_context(file_history))
+                file_context_for_prompt = file_context_cache[1]
 
                 # Reconstruct the history for the next API call
                 if provider == "google":
-                    # Rebuild history for Google
-                    temp_history = conversation_history[-10:] # Limit history again
-                    history_for_google_continue = []
-                    for entry in temp_history:
-                        role = entry['role']
-                        if role in ['user', 'model']:
-                            history_for_google_continue.append({"role": role, "parts": [entry['content']]})
+                    # Rebuild history for Google (conversation_history is bounded to HISTORY_WINDOW)
+                    generation_request_content = _provider_history(conversation_history, provider)
 
                     # Construct the new user prompt string including reminder, files, and "CONTINUE"
                     prompt_string_for_google_continue = "\n\n".join([
@@ -1985,23 +2564,17 @@ def chat_with_model(client_or_model, provider, model_name): # Modified signature
                         "CONTINUE."
                     ])
                     # Update generation_request_content for the *next* iteration
-                    generation_request_content = history_for_google_continue + [{"role": "user", "parts": [prompt_string_for_google_continue]}]
+                    generation_request_content.append({"role": "user", "parts": [prompt_string_for_google_continue]})
 
                 elif provider == "openrouter":
-                    # Rebuild history for OpenRouter
-                    temp_history = conversation_history[-10:] # Limit history again
-                    history_for_openai_continue = [{"role": "system", "content": reminder_system_prompt}] # Start with reminder
-                    for entry in temp_history:
-                        role = entry['role']
-                        if role == 'user':
-                            history_for_openai_continue.append({"role": "user", "content": entry['content']})
-                        elif role == 'model':
-                           history_for_openai_continue.append({"role": "assistant", "content": entry['content']})
+                    # Rebuild history for OpenRouter (conversation_history is bounded to HISTORY_WINDOW)
+                    history_for_model = [{"role": "system", "content": reminder_system_prompt}] # Start with reminder
+                    history_for_model.extend(_provider_history(conversation_history, provider))
 
                     # Construct the new user prompt string including file context and "CONTINUE"
                     user_content_for_openai_continue = f"{file_context_for_prompt}\n\nCONTINUE."
                     # Update history_for_model for the *next* iteration
-                    history_for_model = history_for_openai_continue + [{"role": "user", "content": user_content_for_openai_continue}]
+                    history_for_model.append({"role": "user", "content": user_content_for_openai_continue})
                 # --- Prepare for next segment --- End
 
 
@@ -2014,7 +2587,11 @@ def chat_with_model(client_or_model, provider, model_name): # Modified signature
                 files_found = []
                 file_options = []
                 for i, filepath in enumerate(files_to_ask_user_for):
-                    if os.path.isfile(filepath):
+                    try:
+                        is_file = stat.S_ISREG(os.stat(filepath).st_mode)
+                    except OSError:
+                        is_file = False
+                    if is_file:
                         print(f"{Fore.GREEN}  {i+1}. {filepath} (Found){Style.RESET_ALL}")
                         files_found.append(filepath)
                         file_options.append(filepath)
@@ -2029,29 +2606,36 @@ def chat_with_model(client_or_model, provider, model_name): # Modified signature
                     if selection_input.strip():
                         try:
                             selected_indices = [int(idx.strip()) - 1 for idx in selection_input.split(',') if idx.strip()]
-                            temp_selected_context = ""
+                            temp_selected_context = []
+                            paths_to_read = []
+                            read_futures = []
                             for idx in selected_indices:
                                 if 0 <= idx < len(file_options):
-                                    selected_filepath = file_options[idx]
-                                    selected_filenames_for_note.append(selected_filepath)
-                                    try:
-                                        with open(selected_filepath, 'r', encoding='utf-8') as f:
-                                            file_content = f.read()
-                                            # numbered_content = _format_content_with_lines(file_content) # Removed call
-                                            temp_selected_context += f"\n{Fore.CYAN}=== {selected_filepath} ==={Style.RESET_ALL}\n" # Removed (Line Numbered)
-                                            temp_selected_context += f"```\n{file_content}\n```\n" # Use raw file_content
-                                            print(f"{Fore.GREEN}  ✓ Added {selected_filepath}{Style.RESET_ALL}")
-
-                                            # Add file to tracking lists if not already there
-                                            norm_filepath = os.path.normpath(selected_filepath)
-                                            if norm_filepath not in file_history["current_workspace"]:
-                                                file_history["current_workspace"].append(norm_filepath)
-                                    except Exception as e:
-                                        print(f"{Fore.RED}  ✗ Error reading {selected_filepath}: {e}{Style.RESET_ALL}")
+                                    paths_to_read.append(file_options[idx])
                                 else:
                                     print(f"{Fore.RED}  ✗ Invalid number skipped: {idx+1}{Style.RESET_ALL}")
+                            if paths_to_read:
+                                # Read all selected files concurrently, then report in selection order
+                                with ThreadPoolExecutor(max_workers=min(8, len(paths_to_read))) as executor:
+                                    # Strict UTF-8 (like the old text-mode read): undecodable files raise and are reported below
+                                    read_futures = [executor.submit(_read_text, path) for path in paths_to_read]
+                            for selected_filepath, future in zip(paths_to_read, read_futures):
+                                selected_filenames_for_note.append(selected_filepath)
+                                try:
+                                    file_content = future.result()
+                                    temp_selected_context.append(f"\n{Fore.CYAN}=== {selected_filepath} ==={Style.RESET_ALL}\n") # Removed (Line Numbered)
+                                    temp_selected_context.append(f"```\n{file_content}\n```\n") # Use raw file_content
+                                    print(f"{Fore.GREEN}  ✓ Added {selected_filepath}{Style.RESET_ALL}")
+
+                                    # Add file to tracking lists if not already there
+                                    norm_filepath = _norm(selected_filepath)
+                                    if norm_filepath not in file_history["current_workspace"]:
+                                        file_history["current_workspace"][norm_filepath] = None
+                                        file_history_version += 1
+                                except Exception as e:
+                                    print(f"{Fore.RED}  ✗ Error reading {selected_filepath}: {e}{Style.RESET_ALL}")
                             if temp_selected_context:
-                                selected_files_content = f"{Style.BRIGHT}{Fore.GREEN}--- Providing Content for User-Selected Files ---{Style.RESET_ALL}\n" + temp_selected_context
+                                selected_files_content = f"{Style.BRIGHT}{Fore.GREEN}--- Providing Content for User-Selected Files ---{Style.RESET_ALL}\n" + "".join(temp_selected_context)
                             else: print(f"{Fore.YELLOW}No valid files selected or read.{Style.RESET_ALL}")
                         except ValueError: print(f"{Fore.RED}Invalid input format. Please enter numbers separated by commas.{Style.RESET_ALL}")
                 if selected_files_content:
@@ -2138,7 +2722,6 @@ def chat_with_model(client_or_model, provider, model_name): # Modified signature
             main_loop_interrupted = True # Set flag to break outer loop
         except Exception as e:
             print(f"\n{Back.RED}{Fore.WHITE} UNEXPECTED ERROR: {e} {Style.RESET_ALL}")
-            import traceback
             traceback.print_exc()
             conversation_history.append({"role": "system", "content": f"An unexpected error occurred: {e}\n{traceback.format_exc()}"})
 
@@ -2147,29 +2730,6 @@ def chat_with_model(client_or_model, provider, model_name): # Modified signature
 
     # ... (end of chat_with_model) ...
 
-def generate_diff_report(file_lines, ai_old_code_lines, best_match_start_line):
-    """Generates a diff-like report comparing AI's old code and actual file lines."""
-    report = []
-    file_slice = file_lines[best_match_start_line : best_match_start_line + len(ai_old_code_lines)]
-    diff = difflib.ndiff(file_slice, ai_old_code_lines)
-    
-    report.append("--- Diff Report (File vs. Your Attempted Old Code) ---")
-    for i, line in enumerate(diff):
-        file_line_num = best_match_start_line + i + 1
-        prefix = line[:2]
-        content = line[2:]
-        if prefix == '+ ': # Lines only in AI's code (shouldn't happen if copied?)
-            report.append(f"AI Only (?): {repr(content)}") 
-        elif prefix == '- ': # Lines only in File code
-            report.append(f"File (L{file_line_num}):  {repr(content)}")
-        elif prefix == '  ': # Lines matching
-            report.append(f"Match (L{file_line_num}): {repr(content)}")
-        elif prefix == '? ': # Difference hints
-            # report.append(f"Hint:         {content}") # Optional: Show hints 
-            pass
-    report.append("------------------------------------------------------")
-    return "\n".join(report)
-
 def main():
     """Main entry point for the CLI."""
     # --- Clear Terminal ---
@@ -2196,6 +2756,8 @@ def main():
     # Add OpenRouter model argument
     parser.add_argument("--omodel", default=None, help="OpenRouter model to use (e.g., 'mistralai/mistral-7b-instruct', 'google/gemini-pro'). Overrides --model.")
     # Default OpenRouter model if --omodel is present but without a value? No, let user specify.
+    # Skip the per-segment confirmation prompts (scripted / headless use)
+    parser.add_argument("--yes", "-y", action="store_true", help="Apply proposed file changes and run proposed terminal commands without asking")
     # Add version argument
     parser.add_argument("--version", action="version", version=f"%(prog)s {__version__}")
 
@@ -2206,7 +2768,7 @@ def main():
     client_or_model, provider, model_name_used = initialize_model(args)
 
     # Start chat with the initialized model
-    chat_with_model(client_or_model, provider, model_name_used)
+    chat_with_model(client_or_model, provider, model_name_used, auto_confirm=args.yes)
 
 
 if __name__ == "__main__":